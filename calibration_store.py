@@ -0,0 +1,177 @@
+import os
+
+
+# example use of this module:
+#   from calibration_store import CalibrationStore
+#   store = CalibrationStore()
+#   store.load()                                    # one file open, brings in the old .txt files the first time
+#   sensitivity = store.get_int('ir_l', 0, 65535)   # None if it's missing or doesn't make sense
+#   store.set('ir_l', 31000)
+#   store.save()                                    # atomic, a power cut never leaves half a file
+#
+# The file is simple key=value lines, the first being the schema version:
+#   version=1
+#   ir_l=31000
+#   pid=1.15,0.0001,10.0
+#   motor_speeds=20,0,0;24,35,31;...        (a table: rows separated by ';', columns by ',')
+
+SCHEMA_VERSION = 1
+FILENAME = 'calibration.txt'
+
+# key -> the file it used to live in, before there was a calibration store
+LEGACY_FILES = {
+    'rgb_road': 'rgb_road.txt',
+    'ir_l': 'ir_l.txt',
+    'ir_r': 'ir_r.txt',
+    'pid': 'pid.txt',
+    'motor_offsets': 'motor.txt',
+    'motor_speeds': 'motor_speed.txt',
+}
+
+
+def format_value(value):
+    """ints/floats as is, a list of numbers as 'a,b,c' and a list of rows (lists) as a table 'a,b;c,d'"""
+    if isinstance(value, (list, tuple)):
+        if len(value) > 0 and isinstance(value[0], (list, tuple)):
+            return ";".join([",".join([str(v) for v in row]) for row in value])
+        return ",".join([str(v) for v in value])
+    return str(value)
+
+
+class CalibrationStore:
+    def __init__(self, filename=FILENAME):
+        """Every calibration value the vehicle has (sensor thresholds, PID gains, motor tables) in one file,
+        read with one open and written atomically. Each entry is checked when it is read, and dropped if it
+        doesn't make sense so it gets recalibrated rather than crashing us"""
+        self.filename = filename
+        self.entries = {}  # key -> value as text
+
+    # - - - - - - - - - - - - - - - - - - - - FILE - - - - - - - - - - - - - - - - - - - - #
+    def load(self):
+        """Reads the store. If there isn't one (or it is from a different schema version) we start from the
+        old separate calibration files instead. Returns True if the store file was loaded"""
+        self.entries = {}
+        try:
+            f = open(self.filename, 'r')
+            lines = f.read().split('\n')
+            f.close()
+        except OSError:
+            lines = []
+
+        for line in lines:
+            if '=' in line:
+                key, value = line.split('=', 1)
+                self.entries[key.strip()] = value.strip()
+
+        if self.entries.get('version') != str(SCHEMA_VERSION):
+            self.entries = {}
+            if self.migrate_legacy():
+                self.save()
+            return False
+        return True
+
+    def save(self):
+        """Write to a temporary file then rename it over the store, so the store is always either the old or
+        the new version and never half written. NOTE: relies on rename replacing an existing file in one step,
+        which littlefs (the Pico's filesystem) does"""
+        tmp = self.filename + '.tmp'
+        f = open(tmp, 'w')
+        f.write('version={}\n'.format(SCHEMA_VERSION))
+        for key in self.entries:
+            if key != 'version':
+                f.write('{}={}\n'.format(key, self.entries[key]))
+        f.close()
+        os.rename(tmp, self.filename)
+
+    def migrate_legacy(self):
+        """Bring in the old one-file-per-calibration files (left where they are). Returns True if we found any"""
+        found = False
+        for key in LEGACY_FILES:
+            try:
+                f = open(LEGACY_FILES[key], 'r')
+                text = f.read().strip()
+                f.close()
+            except OSError:
+                continue
+            if key.startswith('motor_'):  # csv with a header line -> table
+                text = ";".join([line.strip() for line in text.split('\n')[1:] if line.strip() != ""])
+            self.entries[key] = text
+            found = True
+        return found
+
+    # - - - - - - - - - - - - - - - - - - - - ENTRIES - - - - - - - - - - - - - - - - - - - - #
+    def set(self, key, value):
+        """Set an entry (see format_value), call save() to keep it"""
+        self.entries[key] = format_value(value)
+
+    def remove(self, key):
+        if key in self.entries:
+            del self.entries[key]
+
+    def invalid(self, key):
+        """Drop an entry that failed its checks so it gets recalibrated"""
+        print("calibration_store.py: '{}' is invalid, ignoring it".format(key))
+        self.remove(key)
+
+    def get_int(self, key, lo, hi):
+        """The entry as an int, or None if it is missing or not in lo -> hi"""
+        text = self.entries.get(key)
+        if text is None:
+            return None
+        try:
+            value = int(text)
+        except ValueError:
+            value = None
+        if value is None or not lo <= value <= hi:
+            self.invalid(key)
+            return None
+        return value
+
+    def get_ints(self, key, count):
+        """The entry as a list of count ints, or None if it is missing or isn't count whole numbers"""
+        text = self.entries.get(key)
+        if text is None:
+            return None
+        try:
+            values = [int(v) for v in text.split(',')]
+        except ValueError:
+            values = []
+        if len(values) != count:
+            self.invalid(key)
+            return None
+        return values
+
+    def get_floats(self, key, count):
+        """The entry as a list of count floats, or None if it is missing or isn't count numbers"""
+        text = self.entries.get(key)
+        if text is None:
+            return None
+        try:
+            values = [float(v) for v in text.split(',')]
+        except ValueError:
+            values = []
+        if len(values) != count:
+            self.invalid(key)
+            return None
+        return values
+
+    def get_table(self, key, num_columns):
+        """The entry as a list of num_columns columns (lists of ints), or None if it is missing, empty or has
+        rows of the wrong length"""
+        text = self.entries.get(key)
+        if text is None:
+            return None
+        columns = [[] for _ in range(num_columns)]
+        try:
+            for row in text.split(';'):
+                values = [int(v) for v in row.split(',')]
+                if len(values) != num_columns:
+                    raise ValueError
+                for i in range(0, num_columns):
+                    columns[i].append(values[i])
+        except ValueError:
+            columns = None
+        if columns is None or len(columns[0]) == 0:
+            self.invalid(key)
+            return None
+        return columns
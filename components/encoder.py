@@ -12,6 +12,8 @@ class EncoderClicker(object):
         self.pin_right = Pin(pin_right, Pin.IN)
         self._count_left = 0
         self._count_right = 0
+        self._base_left = 0  # counts cleared so far, so the totals keep going across clear_count (see odometry.py)
+        self._base_right = 0
         self.left_interrupt = self.pin_left.irq(trigger=Pin.IRQ_RISING | Pin.IRQ_FALLING, handler=self.left_callback)
         self.right_interrupt = self.pin_right.irq(trigger=Pin.IRQ_RISING | Pin.IRQ_FALLING, handler=self.right_callback)
 
@@ -49,7 +51,19 @@ class EncoderClicker(object):
     def get_right(self):
         return self._count_right
 
+    def get_total_left(self):
+        # Count since we started, clear_count doesn't reset it
+        return self._base_left + self._count_left
+
+    def get_total_right(self):
+        return self._base_right + self._count_right
+
     def clear_count(self):
-        # Reset the counts of both encoders to zero
-        self._count_left = 0
-        self._count_right = 0
+        # Reset the counts of both encoders to zero, moving them into the totals. Subtract what we read rather
+        # than assigning zero, so a click that interrupts us between the two lines isn't lost
+        count = self._count_left
+        self._base_left += count
+        self._count_left -= count
+        count = self._count_right
+        self._base_right += count
+        self._count_right -= count
@@ -1,25 +1,43 @@
+from array import array
+
+# duty lookup table: per-mille (0-1000) -> duty_u16 (0-65535), worked out once instead of every call
+_DUTY_U16 = array('H', (int(65535 * i / 1000 + 0.5) for i in range(0, 1001)))
+
+# motor direction constants (what the IN1/IN2 pins are currently set to)
+_FORWARDS = 1
+_BACKWARDS = -1
+_BRAKE = 0
+
+
 class Motor(object):
     """ A ``motor`` object is used to control a DC motor using the L298N dual H-bridge.
         The Motor class has methods to change the direction of the motor by setting
         the IN1/IN2 pins:
         - ``Motor.set_forwards()``
         - ``Motor.set_backwards()``
-         and a method to change the duty cycle (0-100%) of the PWM output:
+        - ``Motor.brake()``
+         and methods to change the duty cycle (0-100%, or 0-1000 per-mille) of the PWM output:
         - ``Motor.duty(pwm)``
+        - ``Motor.duty_permille(permille)``
+        The current direction and duty are remembered, so setting them to what they
+        already are doesn't touch the GPIO/PWM at all (cheap to call every loop).
         """
 
-    def __init__(self, side, in1_pin, in2_pin, en_pin):
+    def __init__(self, side, in1_pin, in2_pin, en_pin, freq=1000):
         """
                 :rtype: object
                 :type side: str
                 :type in1_pin: int
                 :type in2_pin: int
                 :type en_pin: str
+                :type freq: int
                 The arguments are:
                 - ``side``  should be the strings: "left" or "right". Used to specify motor.
                 - ``in1_pin`` should be a valid Pin name string.
                 - ``in2_pin`` should be a valid Pin name string
                 - ``en_pin`` should be the strings: 6 or 7
+                - ``freq`` PWM frequency in Hz. Lower frequencies give more torque at low duty
+                  (a smaller deadband) but whine more
                 Usage Model::
                 # Initialise motor instance
                 left_motor = Motor("left", 8, 9, 7)
@@ -38,28 +56,56 @@ class Motor(object):
         self.IN2 = Pin(in2_pin, Pin.OUT)
         # Declare GPIO pins for PWM EN pin
         self.EN = PWM(Pin(en_pin))
+        self.EN.freq(freq)
+
+        # The motors are mounted mirrored, so forwards is IN1 high for the left motor but IN2 high for the right.
+        # Work out the pin levels once here rather than checking the side every time we set a direction
+        if self.side == "left":
+            self.fwd_in1, self.fwd_in2 = 1, 0
+        else:  # only other motor is the right motor
+            self.fwd_in1, self.fwd_in2 = 0, 1
+
+        # Remember what we last wrote so we can skip redundant writes (None forces the first write)
+        self.direction = None
+        self.duty_16 = None
 
         print("Motor", self.side, "initialised!")
 
     def duty(self, pwm):
-        pwm_16 = 655*pwm
-        self.EN.duty_u16(pwm_16)
+        """Set the duty cycle as a percentage (0-100). Floats are fine, e.g. 37.4, since this is
+        mapped with a resolution of 0.1%"""
+        self.duty_permille(int(pwm * 10 + 0.5))
+
+    def duty_permille(self, permille):
+        if permille < 0:  # the table only covers 0-1000, so clamp rather than wrap or raise
+            permille = 0
+        elif permille > 1000:
+            permille = 1000
+        pwm_16 = _DUTY_U16[permille]
+        if pwm_16 != self.duty_16:
+            self.EN.duty_u16(pwm_16)
+            self.duty_16 = pwm_16
         """ The duty cycle must be declared as a uint 16 variable between 0 and 65,535.
-            Therefore, to set the duty cycle to 100%, we set it to 65535.
+            Therefore, to set the duty cycle to 100% (1000 per-mille), we set it to 65535.
             """
 
     def set_forwards(self):
-        if self.side == "left":
-            self.IN1.on()
-            self.IN2.off()
-        else:  # only other motor is the right motor
-            self.IN1.off()
-            self.IN2.on()
+        if self.direction != _FORWARDS:
+            self.IN1.value(self.fwd_in1)
+            self.IN2.value(self.fwd_in2)
+            self.direction = _FORWARDS
 
     def set_backwards(self):
-        if self.side == "left":
-            self.IN1.off()
-            self.IN2.on()
-        else:
+        if self.direction != _BACKWARDS:
+            self.IN1.value(self.fwd_in2)
+            self.IN2.value(self.fwd_in1)
+            self.direction = _BACKWARDS
+
+    def brake(self):
+        """Actively brake: with both IN pins high (and EN on) the L298N shorts the motor terminals together,
+        which stops the wheel much quicker than coasting with a duty of 0"""
+        if self.direction != _BRAKE:
             self.IN1.on()
-            self.IN2.off()
+            self.IN2.on()
+            self.direction = _BRAKE
+        self.duty(100)
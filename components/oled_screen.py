@@ -1,4 +1,4 @@
-from lib.ssd1306 import SSD1306_I2C
+from lib.ssd1306 import SSD1306_I2C, SET_COL_ADDR, SET_PAGE_ADDR
 
 
 # example use of this module:
@@ -20,6 +20,8 @@ _SCREEN_SIZE = _COL_SIZE * _ROW_SIZE  # chars
 
 
 class Screen:
+    PAGES = _HEIGHT // 8  # the screen is sent in 8px high pages, see show_page
+
     def __init__(self, bus):
         """Initialise Screen object"""
         # create oled object with correct screen size (128px * 64px)
@@ -38,25 +40,50 @@ class Screen:
         self.oled.text(message, col*_CHAR_WIDTH, row*_CHAR_HEIGHT, colour)
         self.oled.show()
 
+    def show_page(self, page):
+        """Send one 8px high page (0 -> Screen.PAGES - 1) of what has been drawn to the screen. Sending the pages
+        one at a time lets a cooperative task yield in between (see runtime.DisplayBuffer.flush_async),
+        where show() sends the whole screen in one long transfer"""
+        oled = self.oled
+        oled.write_cmd(SET_COL_ADDR)
+        oled.write_cmd(0)
+        oled.write_cmd(_WIDTH - 1)
+        oled.write_cmd(SET_PAGE_ADDR)
+        oled.write_cmd(page)
+        oled.write_cmd(page)
+        oled.write_data(memoryview(oled.buffer)[page * _WIDTH:(page + 1) * _WIDTH])
+
+    def show(self):
+        self.oled.show()
+
     def print_variable(self, message, col, row):
         """Print a message in a space that must be cleared first. This is useful for printing
         *variable* data that is constantly updating. Has '\n' support, but note that col will
         always stay the same. E.g. if you specify a col of 4, each line will start at col 4.
         Finally, be careful as lines that are too long will run off! Finally, FINALLY, be careful
         of artifacts left if variables are not always constant width"""
+        self.draw_variable(message, col, row)
+        self.oled.show()
+
+    def draw_variable(self, message, col, row):
+        """Same as print_variable, but only draws it. NOTE: DOES NOT SHOW"""
         lines = message.split('\n')
         for i in range(0, len(lines)):
             self.oled.fill_rect(col*_CHAR_WIDTH, (row+i)*_CHAR_HEIGHT, len(lines[i])*_CHAR_WIDTH, 1*_CHAR_HEIGHT, 0)
             self.oled.text(lines[i], col*_CHAR_WIDTH, (row+i)*_CHAR_HEIGHT, 1)
-        self.oled.show()
 
     def print(self, message):
-        """ TODO: These prints are taking ~100ms. Is this function too inefficient?
+        """ These prints take ~100ms, mostly sending the screen over I2C (see show_page).
         Fits a message onto the screen by breaking words apart without mercy.
         Note that print will overwrite any previous prints. Also note that a
         message that is too long is cut off! Now has '\n' support!
             :type message: str"""
-        self.clear()
+        self.draw(message)
+        self.oled.show()
+
+    def draw(self, message):
+        """Same as print, but only draws it. NOTE: DOES NOT SHOW"""
+        self.oled.fill(0)
         row = 0
         col = 0
         i = 0
@@ -79,12 +106,16 @@ class Screen:
                 i += 1
                 col += 1
         self.oled.text(cur_line, 0, row*_CHAR_HEIGHT)
-        self.oled.show()
 
     def print_art(self, message):
         """Same as print but preserves whitespace
             :type message: str"""
-        self.clear()
+        self.draw_art(message)
+        self.oled.show()
+
+    def draw_art(self, message):
+        """Same as print_art, but only draws it. NOTE: DOES NOT SHOW"""
+        self.oled.fill(0)
         row = 0
         col = 0
         i = 0
@@ -106,4 +137,3 @@ class Screen:
                 i += 1
                 col += 1
         self.oled.text(cur_line, 0, row * _CHAR_HEIGHT)
-        self.oled.show()
@@ -1,5 +1,6 @@
 from lib.APDS9960LITE import APDS9960LITE
 from math import log
+from array import array
 
 # example use of this module:
 #   import rgb_sensor
@@ -11,12 +12,8 @@ from math import log
 
 def rgb_to_hue(r, g, b):
     """calculates a hue from a rgb values ranging between 0 and 255. Algorithm courtesy of shrikanth13 at
-    https://www.geeksforgeeks.org/program-change-rgb-color-model-hsv-color-model/"""
-    h = 0
-    r /= 255
-    g /= 255
-    b /= 255
-
+    https://www.geeksforgeeks.org/program-change-rgb-color-model-hsv-color-model/
+    Done with integer maths (the hue only depends on the ratios of r, g and b) so it doesn't allocate floats"""
     rgb_min = min(r, g, b)
     rgb_max = max(r, g, b)
     diff = rgb_max - rgb_min
@@ -24,15 +21,13 @@ def rgb_to_hue(r, g, b):
     if diff == 0:
         return 0
     elif rgb_max == r:
-        h = 6 + (g - b)/diff
+        h = 360 + 60 * (g - b) // diff
     elif rgb_max == g:
-        h = 2 + (b - r)/diff
-    elif rgb_max == b:
-        h = 4 + (r - g)/diff
-    h *= 60
-    h %= 360
+        h = 120 + 60 * (b - r) // diff
+    else:  # rgb_max == b
+        h = 240 + 60 * (r - g) // diff
 
-    return int(h)
+    return int(h % 360)
 
 
 class RGB:
@@ -54,14 +49,20 @@ class RGB:
         self.B_ADJUSTMENT = 0
         self.road_sensitivity = 100 # below this value is road
 
-    def proximity_mm(self):
-        """WARNING: only reliable for distances <= 50"""
-        prox = self.proximity()
+        # proximity level (0 - 255) -> mm lookup table, so proximity_mm() doesn't have to do any float maths
+        self.prox_mm = array('H', (self.level_to_mm(prox) for prox in range(0, 256)))
+
+    @staticmethod
+    def level_to_mm(prox):
         if prox <= 1:
             return 500
         else:
             return int(log((prox - 1)/255)/(-0.062))
 
+    def proximity_mm(self):
+        """WARNING: only reliable for distances <= 50"""
+        return self.prox_mm[self.proximity()]
+
     def proximity(self):
         """return proximity level"""
         return self.apds9960.prox.proximityLevel
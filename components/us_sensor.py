@@ -18,9 +18,10 @@ class UltraSonic:
         self.MAX_TIMEDIFF_MS = 500  # CONST: max elapsed time (ms) before self.readings is too old (therefore invalid)
         self.ECHO_TIMEOUT_US = int(4000*2/(340.29*1e-3))  # CONST: note 4000mm is the max reasonable range of sensor
         self.SPEED_SOUND = 340.29  # CONST: m/s, for calculating distances
+        self.MM_PER_US_X1E5 = int(0.5 * self.SPEED_SOUND * 1e5 / 1e3)  # CONST: mm travelled per us of echo (x1e5)
 
         # Initialise variables
-        self.readings = array('d', (0 for _ in range(self.NUM_READINGS)))  # array holding previous readings
+        self.readings = array('i', (0 for _ in range(self.NUM_READINGS)))  # array holding previous readings (mm)
         self.t0 = ticks_ms()  # records reference time
         self.total = 0  # records sum of readings array
         self.read_index = 0  # records the read index for the readings array
@@ -50,8 +51,8 @@ class UltraSonic:
         # Calculate the distance in mm, based on the delay before we hear
         # an echo and the constant speed of sound.
         # Note: duration is halved as the audio wave must travel there and back.
-        mm = 0.5 * duration * 1e-6 * self.SPEED_SOUND * 1e3
-        return mm
+        # mm = 0.5 * duration * 1e-6 * SPEED_SOUND * 1e3, done with integers so we don't allocate a float
+        return duration * self.MM_PER_US_X1E5 // 100000
 
     def reset_sensor(self):
         """reset the sensor reading array with new values. Warning: this could take
@@ -63,8 +64,9 @@ class UltraSonic:
             self.total += self.readings[i]
         self.t0 = ticks_ms()
 
-    def proximity(self):
-        """uses smoothing algorithm by David A. Mellis and Tom Igoe https://www.arduino.cc/en/Tutorial/Smoothing"""
+    def update(self):
+        """takes a new reading into the readings array, uses smoothing algorithm by David A. Mellis and Tom Igoe
+        https://www.arduino.cc/en/Tutorial/Smoothing"""
         # if our most recent reading is too old, redo the whole array
         # NOTE: that the oldest reading can be MAX_TIMEDIFF_MS*NUM_READINGS = 1 second old
         if ticks_diff(ticks_ms(), self.t0) >= self.MAX_TIMEDIFF_MS:
@@ -82,5 +84,12 @@ class UltraSonic:
         # update read_index and ensure it loops back to zero
         self.read_index = (self.read_index + 1) % self.NUM_READINGS
 
-        # return the average of all the readings!
+    def proximity(self):
+        """takes a new reading and returns the average of all the readings!"""
+        self.update()
         return self.total / self.NUM_READINGS
+
+    def proximity_mm(self):
+        """Same as proximity() but returns a whole number of mm, which doesn't allocate a float"""
+        self.update()
+        return self.total // self.NUM_READINGS
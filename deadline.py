@@ -0,0 +1,98 @@
+from time import ticks_us, ticks_diff
+from array import array
+
+
+# example use of this module:
+#   from deadline import DeadlineMonitor
+#   monitor = DeadlineMonitor(period_ms=20)
+#   monitor.add_level("display", skip_display, restore_display)     # shed first
+#   monitor.add_level("telemetry", drop_telemetry, restore_telemetry)  # shed last
+#   while True:
+#       monitor.start()
+#       ...  # one loop iteration
+#       monitor.finish()
+#   monitor.report()
+
+
+class DeadlineMonitor:
+    def __init__(self, period_ms=20, slack=0.5, restore_loops=50):
+        """Watches each loop iteration against a target period. Every overrun sheds one more level of
+        low-priority work (in the order the levels were added), and once we have had restore_loops iterations
+        in a row that used less than slack of the period, the most recently shed level is restored.
+        Shedding and restoring are counted per level"""
+        self.period_us = period_ms * 1000
+        self.slack_us = int(self.period_us * slack)
+        self.restore_loops = restore_loops
+
+        self.names = []     # level -> name
+        self.shed = []      # level -> function that sheds its work
+        self.restore = []   # level -> function that restores it
+        self.shed_count = array('i')
+        self.restore_count = array('i')
+        self.level = 0      # number of levels currently shed
+
+        self.t0 = 0
+        self.slack_streak = 0  # iterations in a row with slack
+        self.last_us = 0       # how long the last iteration took
+        self.loops = 0
+        self.overruns = 0
+        self.worst_us = 0
+
+    def add_level(self, name, shed, restore):
+        """Add a level of work that can be shed. shed() and restore() are called with no arguments"""
+        self.names.append(name)
+        self.shed.append(shed)
+        self.restore.append(restore)
+        self.shed_count.append(0)
+        self.restore_count.append(0)
+
+    def start(self):
+        """Call at the start of each loop iteration"""
+        self.t0 = ticks_us()
+
+    def finish(self):
+        """Call at the end of each loop iteration, sheds or restores work depending on how long it took"""
+        elapsed = ticks_diff(ticks_us(), self.t0)
+        self.last_us = elapsed
+        self.loops += 1
+        if elapsed > self.worst_us:
+            self.worst_us = elapsed
+
+        if elapsed > self.period_us:
+            self.overruns += 1
+            self.slack_streak = 0
+            if self.level < len(self.shed):
+                self.shed[self.level]()
+                self.shed_count[self.level] += 1
+                self.level += 1
+        elif elapsed < self.slack_us:
+            self.slack_streak += 1
+            if self.slack_streak >= self.restore_loops and self.level > 0:
+                self.level -= 1
+                self.restore[self.level]()
+                self.restore_count[self.level] += 1
+                self.slack_streak = 0
+        else:
+            self.slack_streak = 0
+
+    def slack_us(self):
+        """How much of the period the last iteration left unused (negative if it overran)"""
+        return self.period_us - self.last_us
+
+    def restore_all(self):
+        """Bring back everything we shed (e.g. when we stop the loop)"""
+        while self.level > 0:
+            self.level -= 1
+            self.restore[self.level]()
+            self.restore_count[self.level] += 1
+        self.slack_streak = 0
+
+    def is_shed(self, name):
+        """True if the named level is currently shed"""
+        return self.names.index(name) < self.level
+
+    def report(self):
+        print("loops: {}, overruns: {}, worst: {}us, shed now: {}".format(self.loops, self.overruns,
+                                                                          self.worst_us, self.level))
+        for i in range(0, len(self.names)):
+            print("  {}: shed {}, restored {}".format(self.names[i], self.shed_count[i], self.restore_count[i]))
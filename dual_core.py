@@ -0,0 +1,129 @@
+# Runs sensor acquisition (and optionally the screen) on the RP2040's second core with _thread, so slow reads
+# like UltraSonic.distance_mm or I2C transfers never hold up the PID loop on core 0. Works with CPython threads
+# too (only one core there of course, but handy for testing off the vehicle, see tests/conftest.py).
+#
+# The worker refreshes the sensor hub into its own frame, then publishes a copy under a lock. The control loop
+# fetches the latest published frame into its own (vehicle.frame) under the same lock, so neither side ever
+# sees a half-written frame and the lock is only held for a 9 element copy.
+#
+# example use of this module:
+#   from dual_core import SensorWorker, SharedDisplay
+#   display = SharedDisplay(vehicle.screen)
+#   worker = SensorWorker(vehicle.sensors, sm.needed_sensors, display=display)
+#   worker.start()
+#   while True:
+#       worker.fetch(vehicle.frame)   # latest readings, taken on core 1
+#       ...
+#   worker.stop()
+#
+# NOTE: everything on the I2C bus (RGB sensor and screen) must then only be used by the worker
+
+import _thread
+from time import ticks_ms, ticks_diff, sleep_ms
+from sensor_hub import SensorFrame
+from runtime import DisplayBuffer
+
+
+class SharedDisplay(DisplayBuffer):
+    """A DisplayBuffer that can be printed to on one core and flushed on the other. The lock is only held
+    while swapping messages in and out, not while drawing (which is slow)"""
+    def __init__(self, screen):
+        super().__init__(screen)
+        self.lock = _thread.allocate_lock()
+
+    def print(self, message):
+        with self.lock:
+            self.message, self.message_is_art, self.variable = message, False, None
+
+    def print_art(self, message):
+        with self.lock:
+            self.message, self.message_is_art, self.variable = message, True, None
+
+    def print_variable(self, message, col, row):
+        with self.lock:
+            self.variable = (message, col, row)
+
+    def flush(self):
+        with self.lock:
+            message, message_is_art, variable = self.message, self.message_is_art, self.variable
+            self.message, self.variable = None, None
+        if message is not None:
+            if message_is_art:
+                self.screen.print_art(message)
+            else:
+                self.screen.print(message)
+        if variable is not None:
+            self.screen.print_variable(*variable)
+
+
+class SensorWorker:
+    def __init__(self, hub, needed=None, period_ms=10, display=None, display_period_ms=200):
+        """Refreshes a SensorHub every period_ms on another thread/core and publishes the results.
+        - needed: function returning the slots to refresh (e.g. StateMachine.needed_sensors), all if None
+        - display: a SharedDisplay to flush every display_period_ms on the same core, if any"""
+        self.hub = hub
+        self.needed = needed
+        self.period_ms = period_ms
+        self.display = display
+        self.display_period_ms = display_period_ms
+
+        # the hub writes into our back frame from now on, published is what the other core copies from
+        self.back = SensorFrame()
+        self.back.copy_from(hub.frame)
+        hub.frame = self.back
+        self.published = SensorFrame()
+        self.published.copy_from(self.back)
+        self.lock = _thread.allocate_lock()
+
+        self.running = False
+        self.stopped = True
+        self.overruns = 0   # number of times a refresh took longer than period_ms
+        self.error = None   # exception that stopped the worker, if any
+
+    def start(self, timeout_ms=1000):
+        """Start the worker on the other core, and wait (up to timeout_ms) for it to publish its first
+        readings so nobody acts on an empty frame"""
+        seq = self.published.seq
+        self.running = True
+        self.stopped = False
+        _thread.start_new_thread(self.work, ())
+        t0 = ticks_ms()
+        while self.published.seq == seq and not self.stopped and ticks_diff(ticks_ms(), t0) < timeout_ms:
+            sleep_ms(1)
+
+    def stop(self, timeout_ms=1000):
+        """Ask the worker to stop, and wait (up to timeout_ms) for it to finish its current pass"""
+        self.running = False
+        t0 = ticks_ms()
+        while not self.stopped and ticks_diff(ticks_ms(), t0) < timeout_ms:
+            sleep_ms(1)
+
+    def work(self):
+        t_display = ticks_ms()
+        try:
+            while self.running:
+                t0 = ticks_ms()
+                if self.needed is None:
+                    self.hub.refresh_all()
+                else:
+                    self.hub.refresh(self.needed())
+                with self.lock:
+                    self.published.copy_from(self.back)
+
+                if self.display is not None and ticks_diff(t0, t_display) >= self.display_period_ms:
+                    self.display.flush()
+                    t_display = t0
+
+                delay = self.period_ms - ticks_diff(ticks_ms(), t0)
+                if delay > 0:
+                    sleep_ms(delay)
+                else:
+                    self.overruns += 1
+        except Exception as e:  # don't let core 1 die silently, the control loop can check worker.error
+            self.error = e
+        self.stopped = True
+
+    def fetch(self, frame):
+        """Copy the latest published readings into frame (e.g. vehicle.frame)"""
+        with self.lock:
+            frame.copy_from(self.published)
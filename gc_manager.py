@@ -0,0 +1,104 @@
+import gc
+from time import ticks_us, ticks_diff
+from array import array
+
+try:
+    mem_alloc, mem_free = gc.mem_alloc, gc.mem_free
+except AttributeError:  # CPython doesn't have these, so we never know how much we have allocated
+    def mem_alloc():
+        return 0
+
+    def mem_free():
+        return 1 << 30
+
+
+# example use of this module:
+#   from gc_manager import GCManager
+#   gcm = GCManager()
+#   gcm.start()                          # from here on we decide when to collect
+#   while True:
+#       ...  # one loop iteration
+#       gcm.track(sm.state)              # heap high-water mark per state
+#       gcm.idle(monitor.slack_us())     # collect if there is time for it (and something to collect)
+#   gcm.report(sm.name)
+
+
+class GCManager:
+    def __init__(self, collect_bytes=8192, min_free=8192, disable=True, threshold=None):
+        """Stops the automatic garbage collector from landing at random points in the control loop, and
+        collects in the loop's slack time instead.
+        - collect_bytes: don't bother collecting until we have allocated this much since the last collection
+        - min_free: if the heap gets this full, collect even if there isn't time for it
+        - disable: turn the automatic collector off (it still runs if an allocation fails)
+        - threshold: instead of disabling, raise the automatic collector's threshold to this many bytes"""
+        self.collect_bytes = collect_bytes
+        self.min_free = min_free
+        self.disable = disable
+        self.threshold = threshold
+
+        self.alloc_after = 0        # heap allocated after the last collection
+        self.pause_us = 2000        # how long we expect a collection to take (the worst we have seen)
+
+        # collection pause times (us): count, forced count, min, max, total
+        self.stats = array('i', (0, 0, 0x7fffffff, 0, 0))
+        self.high_water = {}        # state -> most heap we have seen allocated in that state
+
+    def start(self):
+        """Collect now, then take over from the automatic collector"""
+        self.collect()
+        if self.threshold is not None and hasattr(gc, "threshold"):
+            gc.threshold(self.threshold)
+        elif self.disable:
+            gc.disable()
+
+    def stop(self):
+        """Hand collection back to the automatic collector"""
+        if self.threshold is not None and hasattr(gc, "threshold"):
+            gc.threshold(-1)
+        gc.enable()
+
+    def collect(self, forced=False):
+        t0 = ticks_us()
+        gc.collect()
+        pause = ticks_diff(ticks_us(), t0)
+        self.alloc_after = mem_alloc()
+
+        self.stats[0] += 1
+        if forced:
+            self.stats[1] += 1
+        if pause < self.stats[2]:
+            self.stats[2] = pause
+        if pause > self.stats[3]:
+            self.stats[3] = pause
+            self.pause_us = pause
+        self.stats[4] += pause
+        return pause
+
+    def idle(self, slack_us):
+        """Call when the loop has slack_us to spare. Collects if there is garbage worth collecting and the
+        collection should fit in the slack, or if the heap is nearly full. Returns True if we collected"""
+        if mem_alloc() - self.alloc_after < self.collect_bytes:
+            return False
+        if mem_free() < self.min_free:
+            self.collect(forced=True)
+            return True
+        if slack_us >= self.pause_us:
+            self.collect()
+            return True
+        return False
+
+    def track(self, state):
+        """Record the heap high-water mark for a state, call once per loop"""
+        allocated = mem_alloc()
+        if allocated > self.high_water.get(state, 0):
+            self.high_water[state] = allocated
+
+    def report(self, name=str):
+        """Print the collection pause times and the high-water mark of each state. name turns a state into
+        something readable (e.g. StateMachine.name)"""
+        count = self.stats[0]
+        print("gc: {} collections ({} forced), pause min {}us, mean {}us, max {}us".format(
+            count, self.stats[1], self.stats[2] if count else 0, self.stats[4] // count if count else 0,
+            self.stats[3]))
+        for state in self.high_water:
+            print("  {}: {} bytes".format(name(state), self.high_water[state]))
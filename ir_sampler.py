@@ -0,0 +1,99 @@
+from time import ticks_ms, ticks_diff
+from array import array
+
+
+# example use of this module:
+#   from ir_sampler import IRSampler
+#   sampler = IRSampler(ir, band=2000)   # ir is a components.ir_sensor.InfraRed
+#   while True:
+#       sampler.update()                 # at most once every period_ms, however often it is called
+#       if sampler.changed:              # only act on real transitions
+#           print("on road" if sampler.on_road else "off road", sampler.edge_ms)
+#
+# or let a timer do the sampling: sampler.start_timer() (and sampler.stop_timer()). Then watch sampler.edges
+# for changes instead of sampler.changed, which the timer may have cleared before we look at it
+
+
+class IRSampler:
+    def __init__(self, ir, burst=4, capacity=16, period_ms=5, band=1000):
+        """Oversamples an InfraRed sensor: every period_ms it takes a burst of ADC readings into a preallocated
+        ring of the last capacity readings, and keeps their mean as the filtered value. The on-road state has
+        hysteresis either side of the sensor's threshold (SENSITIVITY): we only go on road above
+        threshold + band and off road below threshold - band, so noise near the threshold doesn't flicker it.
+        Each change is timestamped (edge_ms) and flagged (changed) for the update it happened on"""
+        self.ir = ir
+        self.burst = burst
+        self.capacity = capacity
+        self.period_ms = period_ms
+        self.band = band
+
+        # ring of raw readings, filled with the first reading so the mean starts sensible
+        first = ir.reading()
+        self.ring = array('H', (first for _ in range(capacity)))
+        self.index = 0
+        self.total = first * capacity
+        self.value = first  # filtered reading
+
+        threshold = ir.get_sensitivity()
+        self.on_road = first > threshold
+        self.changed = False
+        self.edge_ms = ticks_ms()  # when on_road last changed
+        self.edges = 0             # how many times on_road has changed
+        self.t_last = ticks_ms()
+        self.timer = None
+
+    def sample(self):
+        """Take a burst of readings into the ring and update the filtered value and on-road state"""
+        for _ in range(0, self.burst):
+            reading = self.ir.reading()
+            self.total += reading - self.ring[self.index]
+            self.ring[self.index] = reading
+            self.index = (self.index + 1) % self.capacity
+        self.value = self.total // self.capacity
+
+        threshold = self.ir.get_sensitivity()
+        if self.on_road:
+            on_road = self.value > threshold - self.band
+        else:
+            on_road = self.value > threshold + self.band
+        self.changed = on_road != self.on_road
+        if self.changed:
+            self.on_road = on_road
+            self.edge_ms = ticks_ms()
+            self.edges += 1
+
+    def update(self):
+        """Sample if period_ms has passed since the last sample (so it can be called as often as we like).
+        Does nothing while the timer is sampling for us"""
+        if self.timer is not None:
+            return
+        now = ticks_ms()
+        if ticks_diff(now, self.t_last) >= self.period_ms:
+            self.t_last = now
+            self.sample()
+
+    def is_on_road(self):
+        self.update()
+        return self.on_road
+
+    def reading(self):
+        """Filtered reading (0 - 65535)"""
+        self.update()
+        return self.value
+
+    def ms_since_edge(self):
+        return ticks_diff(ticks_ms(), self.edge_ms)
+
+    # - - - - - - - - - - - - - - - - - - - - TIMER - - - - - - - - - - - - - - - - - - - - #
+    def start_timer(self):
+        """Sample every period_ms from a hardware timer rather than when we are asked"""
+        from machine import Timer
+        self.timer = Timer(period=self.period_ms, mode=Timer.PERIODIC, callback=self.on_timer)
+
+    def stop_timer(self):
+        if self.timer is not None:
+            self.timer.deinit()
+            self.timer = None
+
+    def on_timer(self, timer):
+        self.sample()
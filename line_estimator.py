@@ -0,0 +1,67 @@
+# example use of this module:
+#   from line_estimator import LineEstimator
+#   line = LineEstimator(ir_l_levels=(40000, 8000), ir_r_levels=(41000, 9000))   # (road, off-road) readings
+#   offset = line.update(ir_l.reading(), ir_r.reading())
+#   vehicle.pid.set_velocity(200 - offset, 200 + offset)   # steer back towards the middle of the road
+#
+# Everything is done in integer maths (fractions are per-mille), so an update doesn't allocate.
+
+PER_MILLE = 1000
+
+
+def road_fraction(reading, road, off_road):
+    """How much (0 -> 1000) of what a sensor sees is road, from its road and off-road levels. Works whichever
+    way round the levels are (IR reads higher over road, the RGB ambient reads lower)"""
+    fraction = (reading - off_road) * PER_MILLE // (road - off_road) if road != off_road else 0
+    return min(max(fraction, 0), PER_MILLE)
+
+
+class LineEstimator:
+    def __init__(self, ir_l_levels, ir_r_levels, rgb_levels=None, span_mm=40, lost_below=150, found_above=350):
+        """Estimates how far (mm) the middle of the vehicle is from the middle of the road from the analog
+        IR readings, rather than just whether each sensor is on the road. Each sensor's reading is turned into
+        the fraction of road it sees using its road and off-road levels (from calibration), and the offset is
+        the difference between the two sides scaled by half the distance between the sensors (span_mm).
+        Positive means we are right of the middle (so steer left).
+        - rgb_levels: if given, the (centre) RGB ambient reading is folded in: when it sees off-road too we
+          must be further off than the IR sensors alone can tell, so the offset is scaled up (to at most 2x)
+        - lost_below/found_above: hysteresis (per-mille of road) on deciding we have lost the road: lost once
+          both IR sensors see less than lost_below, found again once either sees more than found_above. While
+          lost we hold the last non-zero offset at its full size, so we keep turning back the way we left"""
+        self.ir_l_levels = ir_l_levels
+        self.ir_r_levels = ir_r_levels
+        self.rgb_levels = rgb_levels
+        self.half_span = span_mm // 2
+        self.lost_below = lost_below
+        self.found_above = found_above
+
+        self.offset = 0         # latest estimate (mm)
+        self.side = 0           # sign of the last offset that wasn't 0 (which side the road went)
+        self.lost = False       # True while neither IR sensor can see the road
+        self.lost_changed = False  # True for the update where lost changed
+
+    def update(self, ir_l, ir_r, ambient=None):
+        """Takes the raw IR (and optionally RGB ambient) readings and returns the new offset estimate (mm)"""
+        road_l = road_fraction(ir_l, *self.ir_l_levels)
+        road_r = road_fraction(ir_r, *self.ir_r_levels)
+
+        was_lost = self.lost
+        if self.lost:
+            self.lost = road_l < self.found_above and road_r < self.found_above
+        else:
+            self.lost = road_l < self.lost_below and road_r < self.lost_below
+        self.lost_changed = self.lost != was_lost
+
+        if self.lost:  # no information, so keep turning back towards where we last saw the road
+            self.offset = 2 * self.half_span * self.side
+            return self.offset
+
+        # left sees more road than right -> the road is to our left -> we are right of the middle
+        offset = (road_l - road_r) * self.half_span // PER_MILLE
+        if self.rgb_levels is not None and ambient is not None:
+            road_c = road_fraction(ambient, *self.rgb_levels)
+            offset = offset * (2 * PER_MILLE - road_c) // PER_MILLE
+        self.offset = offset
+        if offset != 0:
+            self.side = 1 if offset > 0 else -1
+        return offset
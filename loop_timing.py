@@ -0,0 +1,130 @@
+from time import ticks_us, ticks_diff
+from array import array
+
+
+# example use of this module:
+#   from loop_timing import StageTimer
+#   SENSE, CONTROL = 0, 1
+#   timer = StageTimer(("sense", "control"))
+#   timer.enabled = True        # can be flipped at any time, costs next to nothing while off
+#   while True:
+#       timer.start()
+#       read_sensors()
+#       timer.lap(SENSE)
+#       control()
+#       timer.lap(CONTROL)
+#       timer.finish()          # records the whole iteration as the 'loop' row
+#   timer.report()              # or timer.report(screen)
+
+# upper bound (us) of each histogram bucket, anything slower goes in one last overflow bucket
+BUCKET_US = (100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000, 100000, 200000)
+
+
+class StageTimer:
+    def __init__(self, stages, bucket_us=BUCKET_US):
+        """Times each stage of a loop with ticks_us and keeps a fixed-bucket histogram per stage (plus one for
+        the whole loop), along with min, max and mean. Everything is allocated up front so timing a stage
+        doesn't allocate. While enabled is False, start/lap/finish return straight away"""
+        self.names = tuple(stages) + ("loop",)
+        self.num_stages = len(self.names)
+        self.bounds = array('i', bucket_us)
+        self.num_buckets = len(bucket_us) + 1
+        self.enabled = False
+
+        self.counts = array('i', (0 for _ in range(self.num_stages * self.num_buckets)))
+        self.n = array('i', (0 for _ in range(self.num_stages)))
+        self.min_us = array('i', (0 for _ in range(self.num_stages)))
+        self.max_us = array('i', (0 for _ in range(self.num_stages)))
+        self.total_us = array('I', (0 for _ in range(self.num_stages)))  # wraps after ~70 minutes, reset() first
+        self.reset()
+
+        self.t_start = 0  # start of the iteration
+        self.t_lap = 0    # end of the last stage
+
+    def reset(self):
+        for i in range(0, len(self.counts)):
+            self.counts[i] = 0
+        for stage in range(0, self.num_stages):
+            self.n[stage] = 0
+            self.min_us[stage] = 0x7fffffff
+            self.max_us[stage] = 0
+            self.total_us[stage] = 0
+
+    def record(self, stage, us):
+        bucket = 0
+        while bucket < self.num_buckets - 1 and us > self.bounds[bucket]:
+            bucket += 1
+        self.counts[stage * self.num_buckets + bucket] += 1
+        self.n[stage] += 1
+        self.total_us[stage] += us
+        if us < self.min_us[stage]:
+            self.min_us[stage] = us
+        if us > self.max_us[stage]:
+            self.max_us[stage] = us
+
+    def start(self):
+        """Call at the start of each loop iteration"""
+        if self.enabled:
+            self.t_start = self.t_lap = ticks_us()
+
+    def lap(self, stage):
+        """Call at the end of a stage, records the time since the last lap (or start)"""
+        if self.enabled:
+            now = ticks_us()
+            self.record(stage, ticks_diff(now, self.t_lap))
+            self.t_lap = now
+
+    def finish(self):
+        """Call at the end of each loop iteration, records the time since start as the 'loop' row"""
+        if self.enabled:
+            self.t_lap = ticks_us()
+            self.record(self.num_stages - 1, ticks_diff(self.t_lap, self.t_start))
+
+    # - - - - - - - - - - - - - - - - - - - - STATISTICS - - - - - - - - - - - - - - - - - - - - #
+    def mean(self, stage):
+        if self.n[stage] == 0:
+            return 0
+        return self.total_us[stage] // self.n[stage]
+
+    def percentile(self, stage, percent=99):
+        """Upper bound (us) of the bucket the given percentile falls in, or the max if it's in the overflow
+        bucket. It's only as fine as the buckets are, but that is plenty to compare before and after"""
+        target = (self.n[stage] * percent + 99) // 100
+        seen = 0
+        for bucket in range(0, self.num_buckets - 1):
+            seen += self.counts[stage * self.num_buckets + bucket]
+            if seen >= target:
+                return min(self.bounds[bucket], self.max_us[stage])
+        return self.max_us[stage]
+
+    def histogram(self, stage):
+        """Counts per bucket, as a list of (upper bound us, count). The overflow bucket's bound is None"""
+        counts = []
+        for bucket in range(0, self.num_buckets):
+            bound = self.bounds[bucket] if bucket < self.num_buckets - 1 else None
+            counts.append((bound, self.counts[stage * self.num_buckets + bucket]))
+        return counts
+
+    # - - - - - - - - - - - - - - - - - - - - REPORTING - - - - - - - - - - - - - - - - - - - - #
+    def report(self, screen=None):
+        """Prints min/mean/max/p99 (us) of each stage over serial, or a short summary (mean and p99 in ms) to
+        the screen if one is given. Slow (allocates strings, and screens are slow), so not every loop!"""
+        if screen is not None:
+            lines = ["ms    mean  p99"]
+            for stage in range(0, self.num_stages):
+                lines.append("{:6.6s}{:5.1f}{:5.1f}".format(self.names[stage], self.mean(stage) / 1000,
+                                                            self.percentile(stage) / 1000))
+            screen.print("\n".join(lines))
+            return
+
+        print("stage,n,min_us,mean_us,max_us,p99_us")
+        for stage in range(0, self.num_stages):
+            n = self.n[stage]
+            print("{},{},{},{},{},{}".format(self.names[stage], n, self.min_us[stage] if n else 0,
+                                             self.mean(stage), self.max_us[stage], self.percentile(stage)))
+
+    def print_histogram(self, stage):
+        print("{}:".format(self.names[stage]))
+        for (bound, count) in self.histogram(stage):
+            print("  <= {}us: {}".format(bound, count) if bound is not None else "   > {}us: {}".format(
+                self.bounds[-1], count))
@@ -1,5 +1,14 @@
 from vehicle_components import Vehicle
-from time import sleep_ms, ticks_ms, ticks_diff
+from runtime import Runtime, DisplayBuffer
+from state_machine import StateMachine
+from loop_timing import StageTimer
+from deadline import DeadlineMonitor
+from gc_manager import GCManager
+from dual_core import SensorWorker, SharedDisplay
+from reacquire import last_road_side, FOUND, GAVE_UP, PHASE_NAMES
+from sensor_hub import IR_L_ONROAD, IR_R_ONROAD, RGB_DIRECTLY_ONROAD, AMBIENT, RGB_HUE, RGB_PROX, \
+    IR_L_RAW, IR_R_RAW
+from time import ticks_ms, ticks_diff, sleep_ms
 
 # - - - - - - - - - - - - - - - - - - - - - - - RANDOM STUFF - - - - - - - - - - - - - - - - - - - - - - - - - -#
 ascii_cat = ("State: PRINT_ART\n\n    _,,/|\n"
@@ -20,180 +29,446 @@ HAZARD = 4
 LF_FWD = 5
 LF_TURN_LEFT = 6
 LF_TURN_RIGHT = 7
+TRACK_PIECE = 8
 
 
-# - - - - - - - - - - - - - - - - - - - - - - - STATE VARIABLES - - - - - - - - - - - - - - - - - - - - - - - - #
-prev_state = NULL        # Previous state
-state = NULL             # Current state
-is_transition = False    # Transition flag telling us if we just switched states
-t0 = ticks_ms()          # For calculating time spent in a state
-
-
-def update_state_variables():
-    """Updates our previous state (prev_state) variable and transition flag (is_transition).
-    The transition flag tells us if we have just transitioned to a new state. This is helpful
-    in running a piece of code in a state one and once only."""
-    global prev_state, state, is_transition, t0
-    is_transition = prev_state != state
-    prev_state = state
-    if is_transition:
-        t0 = ticks_ms()
-
-
-def print_state(screen):
-    """Print out what state we are in"""
-    global state, is_transition
-    if is_transition:  # Run this ONCE when we have just entered a new state -> avoids flickering
-        if state == NULL:
-            screen.print("State: NULL\n\nNo initial state\nwas specified!")
-        elif state == SPLASH_SCREEN:
-            screen.print_art(ascii_cat)
-        elif state == PRINT_ROAD_INFO:
-            screen.print("State: Road Info")
-        elif state == IDLE:
-            screen.print("State: Idling\n\nI am lost!")
-        elif state == STOP:
-            screen.print("State: Stopped\n\nMy job is done!")
-        elif state == HAZARD:
-            screen.print("State: Hazard\n\nSomething got in\n my way!")
-        elif state == LF_FWD:
-            screen.print("State: Line Foll\n-owing")
-        elif state == LF_TURN_LEFT:
-            screen.print("State: Line Foll\n-owing LEFT")
-        elif state == LF_TURN_RIGHT:
-            screen.print("State: Line Foll\n-owing RIGHT")
-        else:
-            screen.print("State: Not Found")
-
-
-def set_initial_targets(pid):
-    """Sets the initial targets for each state"""
-    global state, is_transition
-    if is_transition:  # Run this ONCE when we have just entered a new state -> otherwise pid control will break
-        # if state == NULL:
-        #     pid.set_target(0, 0)
-        # elif state == SPLASH_SCREEN:
-        #     pid.set_target(0, 0)
-        # elif state == PRINT_ROAD_INFO:
-        #     pid.set_target(0, 0)
-        # elif state == IDLE:
-        #     pid.set_target(0, 0)
-        # elif state == STOP:
-        #     pid.set_target(0, 0)
-        # elif state == HAZARD:
-        #     pid.set_target(0, 0)
-        if state == LF_FWD:
-            pid.set_target(50, 50)
-        elif state == LF_TURN_LEFT:
-            pid.set_target(50, 100)
-        elif state == LF_TURN_RIGHT:
-            pid.set_target(100, 50)
-        else:
-            pid.set_target(0, 0)
+# - - - - - - - - - - - - - - - - - - - - - - - LINE FOLLOWING - - - - - - - - - - - - - - - - - - - - - - - - - #
+LF_SPEED = 250           # mm/s, cruising speed while line following
+LF_STEER_GAIN = 4        # mm/s of steering per mm we are off the middle of the road (see LineEstimator)
+LF_STEER_MAX = 80        # mm/s, most we add to one wheel and take from the other to steer back onto the line
+LF_LOST_MS = 500         # search for the road (IDLE) once it has been lost this long, trust a find once held this long
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - TASK RATES (main_async) - - - - - - - - - - - - - - - - - - - - - #
+CONTROL_PERIOD_MS = 10   # PID + motors
+SENSOR_PERIOD_MS = 20    # sensor sampling
+STATE_PERIOD_MS = 20     # state machine
+DISPLAY_PERIOD_MS = 200  # screen refresh
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - LOOP TIMING (main) - - - - - - - - - - - - - - - - - - - - - - - #
+LOOP_STAGES = ("sense", "header", "enter", "body", "control", "display")  # see StageTimer, stage indices below
+STAGE_SENSE = 0          # read_sensors
+STAGE_HEADER = 1         # global_transitions
+STAGE_ENTER = 2          # sm.enter_next (on_exit/on_enter when we switch state, e.g. the state's screen print)
+STAGE_BODY = 3           # sm.run_state (the state's on_tick)
+STAGE_CONTROL = 4        # control_motors
+STAGE_DISPLAY = 5        # display.update (a page of the screen)
+TIMING_REPORT_LOOPS = 1000  # print the timing report over serial this often (when timing is on)
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - LOAD SHEDDING (main) - - - - - - - - - - - - - - - - - - - - - - #
+LOOP_DEADLINE_MS = 20    # an iteration of main() taking longer than this is an overrun
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - GAIN SCHEDULE - - - - - - - - - - - - - - - - - - - - - - - - - - #
+# Named PID constants for manoeuvres with different dynamics. 'default' is PIDController's own (or autotuned) set,
+# and kp/ki/kd here are scales of it, so autotune_pid retunes every set. The velocity loop (kv_p, kv_i) and the
+# limits aren't autotuned, so they are given as they are.
+#   name:     (kp,   ki,  kd,  kv_p, kv_i,    max_duty, min_duty, max_integral, min_integral)
+GAIN_SCHEDULE = {
+    'cruise': (1.0,  1.0, 1.0, 0.06, 0.00015, 55, -45, 15, -15),  # LF_FWD: velocity mode, allow more duty
+    'turn':   (1.3,  1.0, 0.8, 0.05, 0.0001,  45, -45, 10, -10),  # LF_TURN_*: short stiff arcs
+    'rotate': (0.87, 2.0, 1.2, 0.05, 0.0001,  35, -35, 10, -10),  # roundabout: spinning on the spot
+}
+
+
+def add_gain_schedule(pid):
+    """Registers the GAIN_SCHEDULE with the PID controller, scaled from its 'default' set"""
+    for name in GAIN_SCHEDULE:
+        pid.add_scaled_gain_set(name, *GAIN_SCHEDULE[name])
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - STATE HANDLERS - - - - - - - - - - - - - - - - - - - - - - - - #
+# Every handler is called with the state machine (sm). build_state_machine() hangs the vehicle, screen and sensors
+# off it, so handlers use sm.vehicle, sm.screen and sm.sensors rather than globals. sm.sensors is the vehicle's
+# SensorFrame, so a reading is sm.sensors.values[SLOT] (see sensor_hub.py for the slots).
+
+def stopped_enter(sm, message, art=False):
+    """Common on-enter for the states where we don't drive: print out what state we are in, and stop"""
+    if art:
+        sm.screen.print_art(message)
+    else:
+        sm.screen.print(message)
+    sm.vehicle.pid.use_gains('default')
+    sm.vehicle.pid.set_target(0, 0)
+
+
+# - NULL -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -
+def null_enter(sm):
+    stopped_enter(sm, "State: NULL\n\nNo initial state\nwas specified!")
+
+
+# - SPLASH_SCREEN -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -
+# Prints a cat to the screen for a second
+def splash_enter(sm):
+    stopped_enter(sm, ascii_cat, art=True)
+
+
+def splash_tick(sm):
+    if sm.elapsed_ms() > 1000:
+        sm.transition(PRINT_ROAD_INFO)
+
+
+# - PRINT_ROAD_INFO -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -
+# Displays what our IR/RGB sensors are saying about the road
+def road_info_enter(sm):
+    stopped_enter(sm, "State: Road Info")
+
+
+def road_info_tick(sm):
+    values = sm.sensors.values
+    sm.screen.print_variable("IR-L Road{!s:>7}\n"
+                             "IR-R Road{!s:>7}\n"
+                             "RGB Road{!s:>8}\n"
+                             "RGB Amb{:9d}\n"
+                             "RGB Hue{:9d}\n"
+                             "RGB Prox{:8d}".format(bool(values[IR_L_ONROAD]), bool(values[IR_R_ONROAD]),
+                                                    bool(values[RGB_DIRECTLY_ONROAD]), values[AMBIENT],
+                                                    values[RGB_HUE], values[RGB_PROX]),
+                             0, 2)
+
+
+# - IDLE -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -
+# If we are lost, we go into idle and search for the road (see reacquire.py): sweep towards the side that last saw
+# it, then back the other way, then spiral outwards. The road sensors are sampled as fast as they go meanwhile, and
+# we go straight back to line following once the line estimator sees the road (the same test LF_FWD uses, so we
+# don't bounce between the two)
+def idle_enter(sm):
+    vehicle = sm.vehicle
+    sm.screen.print("State: Idling\n\nI am lost!")
+    vehicle.pid.use_gains('cruise')  # the search drives in velocity mode, like LF_FWD
+
+    ir_l, ir_r = vehicle.ir_l_sampler, vehicle.ir_r_sampler
+    ir_l.start_timer()
+    ir_r.start_timer()
+    sm.ambient_period = vehicle.sensors.periods[AMBIENT]
+    vehicle.sensors.set_period(AMBIENT, 0)
+    vehicle.reacquire.start(last_road_side(ir_l, ir_r))
+    sm.search_phase = None
+
+
+def idle_tick(sm):
+    values = sm.sensors.values
+    line = sm.vehicle.line
+    search = sm.vehicle.reacquire
+    line.update(values[IR_L_RAW], values[IR_R_RAW], values[AMBIENT])
+    status = search.step(not line.lost)
+    if status == FOUND:  # LF_FWD confirms it (and counts how long it took) once it has held the road
+        sm.transition(LF_FWD)
+    elif status == GAVE_UP:
+        search.report()
+        sm.transition(STOP)
+    elif search.phase != sm.search_phase:  # only print when something changes, the screen is slow
+        sm.search_phase = search.phase
+        sm.screen.print("State: Idling\n\nSearching:\n{}".format(PHASE_NAMES[search.phase]))
+
+
+def idle_exit(sm):
+    vehicle = sm.vehicle
+    vehicle.ir_l_sampler.stop_timer()
+    vehicle.ir_r_sampler.stop_timer()
+    vehicle.sensors.set_period(AMBIENT, sm.ambient_period)
+
+
+# - STOP -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -
+# Stop once we have finished our task
+def stop_enter(sm):  # TODO: How does user ask vehicle to go again after finishing track?
+    stopped_enter(sm, "State: Stopped\n\nMy job is done!")
+
+
+# - HAZARD -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -
+# Stop if we encounter a hazard on the road
+def hazard_enter(sm):  # TODO: How do we react to a hazard? Stop? Go Around?
+    stopped_enter(sm, "State: Hazard\n\nSomething got in\n my way!")
+
+
+# - LF_FWD -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -
+# Line-Follow-Forward attempts to follow straight or slightly bendy lines, cruising at a constant speed
+def lf_fwd_enter(sm):
+    sm.screen.print("State: Line Foll\n-owing")
+    sm.vehicle.pid.use_gains('cruise')
+    sm.vehicle.pid.set_velocity(LF_SPEED, LF_SPEED)
+    sm.vehicle.pid.set_coupling(1, 1)  # hold our heading, set_velocity moves the ratio when we steer
+    sm.lost_t0 = ticks_ms()
+
+
+def lf_fwd_tick(sm):
+    values = sm.sensors.values
+    line = sm.vehicle.line
+    # Steer back towards the middle of the road in proportion to how far off it we are (positive -> we are
+    # right of the middle -> veer left). If we lose the road, the estimator keeps us turning back the way we left
+    offset = line.update(values[IR_L_RAW], values[IR_R_RAW], values[AMBIENT])
+    steer = max(min(LF_STEER_GAIN * offset, LF_STEER_MAX), -LF_STEER_MAX)
+    sm.vehicle.pid.set_velocity(LF_SPEED - steer, LF_SPEED + steer)
+
+    if line.lost_changed:  # only print when something changes, the screen is slow
+        sm.screen.print("State: LF_FWD\nlost the road!" if line.lost else "State: LF_FWD\nfound the road")
+        sm.lost_t0 = ticks_ms()
+    if ticks_diff(ticks_ms(), sm.lost_t0) > LF_LOST_MS:
+        if line.lost:  # it isn't just behind us, go and look
+            sm.transition(IDLE)
+        elif sm.vehicle.reacquire.searching:  # held the road since a search found it, so it really did
+            sm.vehicle.reacquire.confirm()
+            sm.vehicle.reacquire.report()
+
+
+# - LF_TURN_LEFT / LF_TURN_RIGHT -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -
+def lf_turn_left_enter(sm):
+    sm.screen.print("State: Line Foll\n-owing LEFT")
+    sm.vehicle.pid.use_gains('turn')
+    sm.vehicle.pid.set_target(50, 100)
+
+
+def lf_turn_right_enter(sm):
+    sm.screen.print("State: Line Foll\n-owing RIGHT")
+    sm.vehicle.pid.use_gains('turn')
+    sm.vehicle.pid.set_target(100, 50)
+
+
+# - TRACK_PIECE -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -
+# Drives whatever manoeuvres are queued on vehicle.motion (see gentle_curve, roundabout), one step per tick so the
+# sensors and the hazard check keep running. Goes back to line following once the queue is done. NOTE: sm.screen
+# is a DisplayBuffer (or SharedDisplay) in every loop, so printing the manoeuvre's name at a handover doesn't stall
+def track_piece_enter(sm):
+    sm.track_piece_name = None
+
+
+def track_piece_tick(sm):
+    motion = sm.vehicle.motion
+    if not motion.step():
+        sm.transition(LF_FWD)
+        return
+    if motion.name() != sm.track_piece_name:  # only print when the manoeuvre changes, the screen is slow
+        sm.track_piece_name = motion.name()
+        if sm.track_piece_name is not None:
+            sm.screen.print(sm.track_piece_name)
+
+
+def track_piece_exit(sm):
+    sm.vehicle.motion.clear()  # e.g. a hazard interrupted us, don't carry on from a stale position later
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - STATE TABLE - - - - - - - - - - - - - - - - - - - - - - - - - - #
+# Adding a state is just adding a row, it doesn't make every loop longer.
+# sensors: which readings (slots of sm.sensors.values) the state uses
+#  id               name               on_enter             on_tick         on_exit  sensors
+STATE_TABLE = (
+    (NULL,            "NULL",            null_enter,          None,           None,    ()),
+    (SPLASH_SCREEN,   "SPLASH_SCREEN",   splash_enter,        splash_tick,    None,    ()),
+    (PRINT_ROAD_INFO, "PRINT_ROAD_INFO", road_info_enter,     road_info_tick, None,    (IR_L_ONROAD, IR_R_ONROAD,
+                                                                                        RGB_DIRECTLY_ONROAD,
+                                                                                        AMBIENT, RGB_HUE, RGB_PROX)),
+    (IDLE,            "IDLE",            idle_enter,          idle_tick,      idle_exit, (IR_L_RAW, IR_R_RAW, AMBIENT)),
+    (STOP,            "STOP",            stop_enter,          None,           None,    ()),
+    (HAZARD,          "HAZARD",          hazard_enter,        None,           None,    ()),
+    (LF_FWD,          "LF_FWD",          lf_fwd_enter,        lf_fwd_tick,    None,    (IR_L_RAW, IR_R_RAW, AMBIENT)),
+    (LF_TURN_LEFT,    "LF_TURN_LEFT",    lf_turn_left_enter,  None,           None,    ()),
+    (LF_TURN_RIGHT,   "LF_TURN_RIGHT",   lf_turn_right_enter, None,           None,    ()),
+    (TRACK_PIECE,     "TRACK_PIECE",     track_piece_enter,   track_piece_tick, track_piece_exit, ()),
+)
+
+
+def build_state_machine(vehicle, screen, sensors):
+    """Creates the state machine from the STATE_TABLE"""
+    sm = StateMachine(fallback=NULL)  # an unknown state id stops us (NULL) rather than crashing
+    sm.vehicle = vehicle
+    sm.screen = screen
+    sm.sensors = sensors
+    for (state_id, name, on_enter, on_tick, on_exit, state_sensors) in STATE_TABLE:
+        sm.add(state_id, name, on_enter, on_tick, on_exit, state_sensors)
+    return sm
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - MAIN LOOP - - - - - - - - - - - - - - - - - - - - - - - - - - #
+def read_sensors(vehicle, sm):
+    """Sensor Data Collection: refresh only the readings the current state needs (plus the safety critical
+    ones, like the hazard proximity, which the sensor hub always keeps current). They are written in place into
+    vehicle.frame, so this doesn't allocate anything"""
+    vehicle.sensors.refresh(sm.needed_sensors())
+
+
+def global_transitions(sm):
+    """Global Transitions: these are IMPORTANT TRANSITIONS which can overwrite anything. They are important as they
+    are reacting to things like obstacles on the road, in which case we want to stop ASAP!"""
+    if sm.sensors.values[RGB_PROX] < 35:  # Something is on the road or obstructing the sensor -> so lets stop
+        sm.transition(HAZARD)
+
+
+def state_machine_step(sm):
+    """One pass through the state machine using the latest sensor data: the global transitions, then the
+    state machine itself (transitions if a state asked to, then runs the current state's on_tick)"""
+    global_transitions(sm)
+    sm.tick()
+
+
+def control_motors(vehicle, sm):
+    """Runs the PID controller and sets the motors (or brakes if we are meant to be stopped), then moves the
+    odometry on by however far the wheels went"""
+    if sm.state == HAZARD or sm.state == STOP:
+        vehicle.brake()  # Hold the wheels still rather than coasting (cheap, nothing is rewritten once braked)
+    else:
+        vehicle.set_motor(*vehicle.pid.run())
+    vehicle.odometry.update()
+
+
+timer = StageTimer(LOOP_STAGES)  # loop stage timing for main(), see LOOP TIMING
 
 
-def elapsed_ms():
-    """Calculates the elapsed ms in the current state, relies on update_state_variables()"""
-    global t0
-    return ticks_diff(ticks_ms(), t0)
+def add_load_shedding(monitor, vehicle, sm, display=None):
+    """Registers the work main() can drop when it is running late, least important first:
+        1. display: main() stops sending the state machine's DisplayBuffer to the screen (a page per iteration),
+           and catches up with the latest once we are restored (skipped if display is None, e.g. when the
+           screen is drawn on the other core)
+        2. telemetry: the PID controller stops printing csv data over serial"""
 
+    def shed_display():
+        display.paused = True
 
-def main(initial_state=NULL):
+    def restore_display():
+        display.paused = False
+
+    def shed_telemetry():
+        vehicle.pid.telemetry = False
+
+    def restore_telemetry():
+        vehicle.pid.telemetry = True
+
+    if display is not None:
+        monitor.add_level("display", shed_display, restore_display)
+    monitor.add_level("telemetry", shed_telemetry, restore_telemetry)
+
+
+def prepare_vehicle(vehicle, build_all=False):
+    """Get the vehicle ready to drive: calibrate any road sensor that isn't (interactive, so it must happen now
+    rather than when the sensor is first used mid-run), then forbid calibrating from here on. If build_all, every
+    component is built now too (needed before a SensorWorker starts, so the cores never build them at once)"""
+    add_gain_schedule(vehicle.pid)  # Give the PID controller our named gain sets for each manoeuvre
+    uncalibrated = vehicle.uncalibrated_sensors()
+    if len(uncalibrated) > 0:
+        vehicle.calibrate_sensors(uncalibrated)
+    vehicle.allow_calibration = False
+    if build_all:
+        vehicle.build_all()
+
+
+def main(initial_state=NULL, timing=False, dual_core=False, vehicle=None):
     """This is our main state machine: a big loop that performs actions based on the current state!
 
     Initialisation: initialise our Vehicle object which initialises objects for each sensor, controller, etc.
+    (unless we were given one) and build the state machine from the STATE_TABLE. Components are built the first
+    time they are used, so the first control tick doesn't wait for sensors the first state doesn't need. Missing
+    calibrations are done before we start though, never mid-run (see prepare_vehicle)
+
+    Sensor Data Collection: refresh the sensor readings the current state needs (read_sensors)
 
-    Sensor Data Collection: collect data from all our sensors
+    State Machine: global transitions, then switching state if asked to (sm.enter_next), then the current
+    state's on_tick (sm.run_state). Each is its own timing stage, so a slow on_enter isn't blamed on the body
 
-    Global Transitions: these are IMPORTANT TRANSITIONS which can overwrite anything. They are important as they
-    are reacting to things like obstacles on the road, in which case we want to stop ASAP!
+    Control Motors: run the PID controller and set the motors (control_motors)
 
-    State Machine Body: goes through all the nitty-gritty details """
+    Each stage is timed by a StageTimer (main.timer), which is off unless timing is True. It can be switched
+    on and off while running with timer.enabled, and reports every TIMING_REPORT_LOOPS loops over serial
 
-    global prev_state, state, is_transition, ascii_cat, t0
+    A DeadlineMonitor watches each iteration against LOOP_DEADLINE_MS: when we overrun, it sheds low priority
+    work (see add_load_shedding) and brings it back once there is slack again
+
+    Automatic garbage collection is switched off so it can't land in the middle of control. A GCManager
+    collects at the end of an iteration instead, when the slack it left is enough for a collection
+
+    The state machine prints into a DisplayBuffer, and each iteration sends at most one page of it to the screen,
+    so a print never holds up control (or the hazard check) for a whole ~100ms screen update
+
+    If dual_core is True, the sensors are read and the screen is drawn on the second core by a SensorWorker,
+    and the sense stage just fetches the latest readings it published. If the worker dies we brake and raise its
+    error rather than drive on with stale readings"""
+
+    # - - - - - - - - - - - - - - - - - - - - - - - INITIALISATION - - - - - - - - - - - - - - - - - - - - - - - #
+    if vehicle is None:
+        vehicle = Vehicle(motor=True, enc=True, screen=True, rgb=True, ir_l=True, ir_r=True, us_l=True, us_r=True,
+                          scan_i2c=False)
+    prepare_vehicle(vehicle, build_all=dual_core)
+    sm = build_state_machine(vehicle, vehicle.screen, vehicle.frame)
+    sm.start(initial_state)         # Set the requested initial state
+    timer.enabled = timing
+    monitor = DeadlineMonitor(LOOP_DEADLINE_MS)
+
+    worker = None
+    display = None
+    if dual_core:  # Core 1 reads the sensors and draws the screen, core 0 only fetches their results
+        sm.screen = SharedDisplay(vehicle.screen)
+        worker = SensorWorker(vehicle.sensors, sm.needed_sensors, SENSOR_PERIOD_MS, sm.screen, DISPLAY_PERIOD_MS)
+        worker.start()
+    else:  # The state machine never prints straight to the (slow) screen, we send it a page per iteration
+        display = DisplayBuffer(vehicle.screen)
+        sm.screen = display
+    add_load_shedding(monitor, vehicle, sm, display)
+    gcm = GCManager()
+    gcm.start()
+
+    loops = 0
+    first_tick = True
+    while True:
+        monitor.start()
+        timer.start()
+        if worker is None:
+            read_sensors(vehicle, sm)
+        else:
+            if worker.error is not None:  # the readings have stopped, so the hazard check would be blind
+                vehicle.brake()
+                print("main.py: sensor worker stopped, braking")
+                raise worker.error
+            worker.fetch(vehicle.frame)
+        timer.lap(STAGE_SENSE)
+        global_transitions(sm)
+        timer.lap(STAGE_HEADER)
+        sm.enter_next()
+        timer.lap(STAGE_ENTER)
+        sm.run_state()
+        timer.lap(STAGE_BODY)
+        control_motors(vehicle, sm)
+        timer.lap(STAGE_CONTROL)
+        if display is not None:
+            display.update()
+        timer.lap(STAGE_DISPLAY)
+        timer.finish()
+        monitor.finish()
+        if first_tick and timer.enabled:  # time to first control tick, by component
+            vehicle.print_boot_profile()
+        first_tick = False
+        gcm.track(sm.state)
+        gcm.idle(monitor.slack_us())
+
+        if timer.enabled:
+            loops += 1
+            if loops >= TIMING_REPORT_LOOPS:
+                timer.report()
+                monitor.report()
+                gcm.report(sm.name)
+                loops = 0
+
+
+def main_async(initial_state=NULL, duration_ms=None):
+    """Same as main(), but each job runs as its own task at its own rate. The state machine prints into a
+    DisplayBuffer, which the display task sends to the real screen a page at a time (flush_async), so a screen
+    update only holds up the control task for a page's transfer rather than a whole ~100ms print. The tasks are
+    cooperative, so the other jobs still run to completion and must stay short"""
 
     # - - - - - - - - - - - - - - - - - - - - - - - INITIALISATION - - - - - - - - - - - - - - - - - - - - - - - #
     vehicle = Vehicle(motor=True, enc=True, screen=True, rgb=True, ir_l=True, ir_r=True, us_l=True, us_r=True)
-    pid = vehicle.pid          # Get PID-control object -> can set motor duties to achieve desired targets
-    screen = vehicle.screen    # Get OLED screen object -> can print useful information
-    state = initial_state      # Set the requested initial state
+    prepare_vehicle(vehicle)
+    display = DisplayBuffer(vehicle.screen)
+    sm = build_state_machine(vehicle, display, vehicle.frame)
+    sm.start(initial_state)
 
-    while True:
-        # - - - - - - - - - - - - - - - - - - - - SENSOR DATA COLLECTION - - - - - - - - - - - - - - - - - - #
-        ir_l_onroad = vehicle.ir_l.is_on_road()
-        ir_r_onroad = vehicle.ir_r.is_on_road()
-        rgb_onroad = vehicle.rgb.is_on_road()  # rgb_onroad is more vague than rgb_directly_onroad
-        rgb_directly_onroad = vehicle.rgb.is_on_road_by_prox()  # more like an IR sensor reading
-        ambient = vehicle.rgb.ambient()
-        rgb_hue = vehicle.rgb.hue()
-        rgb_prox = vehicle.rgb.proximity_mm()
-        us_l = vehicle.us_l.proximity()
-        us_r = vehicle.us_r.proximity()
-
-        # - - - - - - - - - - - - - - - - - - - - GLOBAL TRANSITIONS - - - - - - - - - - - - - - - - - - - - #
-        if rgb_prox < 35:         # Something is on the road or obstructing the sensor -> so lets stop
-            state = HAZARD
-
-        # - - - - - - - - - - - - - - - - - - - - STATE MACHINE HEADER - - - - - - - - - - - - - - - - - - - #
-        update_state_variables()  # Updates prev_state and is_transition flag
-        print_state(screen)       # Prints current state information if we just transitioned
-        set_initial_targets(pid)  # Sets our PID targets if we just transitioned
-
-        # - - - - - - - - - - - - - - - - - - - - STATE MACHINE BODY - - - - - - - - - - - - - - - - - - - - #
-        # - SPLASH_SCREEN -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -
-        # Prints a cat to the screen for a second
-        if state == SPLASH_SCREEN:
-            if elapsed_ms() > 1000:
-                state = PRINT_ROAD_INFO
-
-        # - PRINT_ROAD_INFO -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -
-        # Displays what our IR/RGB sensors are saying about the road
-        elif state == PRINT_ROAD_INFO:
-            screen.print_variable("IR-L Road{!s:>7}\n"
-                                  "IR-R Road{!s:>7}\n"
-                                  "RGB Road{!s:>8}\n"
-                                  "RGB Amb{:9d}\n"
-                                  "RGB Hue{:9d}\n"
-                                  "RGB Prox{:8d}".format(ir_l_onroad, ir_r_onroad, rgb_directly_onroad,
-                                                         ambient, rgb_hue, rgb_prox),
-                                  0, 2)
-
-        # - IDLE -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -
-        # If we are lost, we go into idle and wander around
-        elif state == IDLE:  # TODO: Smarter idle wandering
-            if pid.target_met():
-                pid.set_target(50, 50)
-
-        # - STOP -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -
-        # Stop once we have finished our task
-        elif state == STOP:  # TODO: How does user ask vehicle to go again after finishing track?
-            if is_transition:
-                pid.set_target(0, 0)
-
-        # - HAZARD -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -
-        # Stop if we encounter a hazard on the road
-        elif state == HAZARD:  # TODO: How do we react to a hazard? Stop? Go Around?
-            pass
-
-        # - LF_FWD -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -
-        # Line-Follow-Forward attempts to follow straight or slightly bendy lines
-        elif state == LF_FWD:  # TODO: Fix Line Following
-            # If we finished our target, just go again
-            if pid.target_met():
-                pid.set_target(50, 50)
-
-            # Adjust for slight veers rightwards off the road -> by veering left
-            if ir_l_onroad and not ir_r_onroad:
-                screen.print("State: LF_FWD\nveering right")
-                pid.add_target(-15, 15)
-
-            # Adjust for slight veers leftwards off the road -> by veering right
-            if not ir_l_onroad and ir_r_onroad:
-                screen.print("State: LF_FWD\nveering left")
-                pid.add_target(15, -15)
-
-        # - - - - - - - - - - - - - - - - - - - - CONTROL MOTORS - - - - - - - - - - - - - - - - - - - - #
-        vehicle.set_motor(*pid.run())
+    rt = Runtime()
+    rt.every(CONTROL_PERIOD_MS, control_motors, vehicle, sm)
+    rt.every(SENSOR_PERIOD_MS, read_sensors, vehicle, sm)
+    rt.every(STATE_PERIOD_MS, state_machine_step, sm)
+    rt.every_async(DISPLAY_PERIOD_MS, display.flush_async)
+    rt.run(duration_ms)
+    vehicle.brake()
+    sm.print_history()
 
 
 def test_pid(target_mm_l, target_mm_r, kp, ki, kd, loops=30, sleep=50):
@@ -206,73 +481,73 @@ def test_pid(target_mm_l, target_mm_r, kp, ki, kd, loops=30, sleep=50):
     vehicle.set_motor(0, 0)
 
 
-def run_pid(vehicle, left_target, right_target, n=1):
-    # Divide the targets into n steps or segments
-    left_target_step = left_target/n
-    right_target_step = right_target/n
+def run_pid(vehicle, left_target, right_target, max_vel=250, max_acc=500, coupled=True, gains='default'):
+    """Travel a move as one continuous motion: the PID tracks setpoints that accelerate up to max_vel (mm/s)
+    at max_acc (mm/s^2) and then decelerate to land on the targets, with both wheels finishing together.
+    If coupled, the wheels are also held to the left_target:right_target ratio the whole way. gains is
+    the name of the gain set to use (see GAIN_SCHEDULE). Blocks until we get there, see run_motion"""
+    vehicle.motion.add(left_target, right_target, max_vel, max_acc, gains, coupled)
+    run_motion(vehicle)
 
-    # Set our initial target
-    vehicle.pid.set_target(left_target_step, right_target_step)
 
-    # Once each step is done, add the next step. Loop until we are done!
-    for i in range(0, n, 1):
-        while not vehicle.pid.target_met():
-            vehicle.set_motor(*vehicle.pid.run())
-
-        vehicle.pid.add_target(left_target_step, right_target_step)
+def run_motion(vehicle):
+    """Drive everything queued on vehicle.motion, blocking until it is done. NOTE: nothing else runs meanwhile
+    (no sensors, no hazard check), so in the main loop use the TRACK_PIECE state instead"""
+    while vehicle.motion.step():
+        vehicle.set_motor(*vehicle.pid.run())
+        vehicle.odometry.update()
 
-    # Done, so stop motors
-    vehicle.set_motor(0, 0)
+    # Done, so brake motors
+    vehicle.brake()
 
 
 def gentle_curve(vehicle, turn_left=False, turn_right=False):
-    """ Travel around the gentle curve track piece, in either the left or right direction"""
+    """ Queue the gentle curve track piece, in either the left or right direction. Drive it with the
+    TRACK_PIECE state (or run_motion) """
     if turn_left:
-        vehicle.screen.print("Gentle Curve\n\nTurning left")
-        run_pid(vehicle, 300, 500, 3)
+        vehicle.motion.add(300, 500, name="Gentle Curve\n\nTurning left")
 
     if turn_right:
-        vehicle.screen.print("Gentle Curve\n\nTurning right")
-        run_pid(vehicle, 500, 300, 3)
+        vehicle.motion.add(500, 300, name="Gentle Curve\n\nTurning right")
 
 
 def roundabout(vehicle, exit_):
-    """ Take an any exit on the roundabout track piece! We must first ensure 1 <= exit_ <= 4, then:
+    """ Queue any exit on the roundabout track piece! We must first ensure 1 <= exit_ <= 4, then:
             1 -> turn left
             2 -> travel forward
             3 -> turn right
-            4 -> U-turn """
+            4 -> U-turn
+        Drive it with the TRACK_PIECE state (or run_motion). The quarter turns run into each other
+        without stopping, and we get off by turning to the exit's heading measured by the odometry, so any
+        error from getting on and going around doesn't carry on down the road """
 
     # Ensure that exit_ is a valid exit
     exit_ = (exit_ % 4)
     if exit_ == 0:
         exit_ = 4
 
-    # Travel onto the roundabout
-    vehicle.screen.print("Round About\n\nGetting on")
-    run_pid(vehicle, 40, 40)
-    run_pid(vehicle, -80, 80)
+    # Travel onto the roundabout, remembering which way we came in
+    vehicle.motion.mark_heading()
+    vehicle.motion.add(40, 40, name="Round About\n\nGetting on")
+    vehicle.motion.add(-80, 80, gains='rotate')
 
     for i in range(0, exit_, 1):
         # Complete a quarter turn
-        vehicle.screen.print("Round About\n\nTravelling around {}/{}".format(i, exit_))
-        run_pid(vehicle, 245, 15)
+        vehicle.motion.add(245, 15, name="Round About\n\nTravelling around {}/{}".format(i, exit_))
 
-    # Travel out of the roundabout
-    vehicle.screen.print("Round About\n\nGetting off")
-    run_pid(vehicle, -90, 90)
+    # Travel out of the roundabout: turn to face left, ahead, right or back the way we came (from where we came in)
+    vehicle.motion.turn_to((90, 0, -90, 180)[exit_ - 1], gains='rotate', name="Round About\n\nGetting off")
 
 
 if __name__ == "__main__":
-    v = Vehicle(motor=True, enc=True, screen=True)
+    # One vehicle for the demos and the main loop, main() only builds the sensors when they are first used
+    v = Vehicle(motor=True, enc=True, screen=True, rgb=True, ir_l=True, ir_r=True, us_l=True, us_r=True,
+                scan_i2c=False)
 
-    sleep_ms(1000)
+    # Queue the track pieces (their gain sets are only looked up once they start, after main() has added them)
+    # and drive them from the main loop, so the hazard check stays on the whole way
     roundabout(v, exit_=2)
-
-    sleep_ms(1000)
     gentle_curve(v, turn_right=True)
 
-    del v
-
     sleep_ms(1000)
-    main(SPLASH_SCREEN)
+    main(TRACK_PIECE, vehicle=v)
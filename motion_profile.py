@@ -0,0 +1,119 @@
+from math import sqrt
+
+
+# example use of this module:
+#   from motion_profile import SyncedProfile
+#   profile = SyncedProfile(300, 500, max_vel=250, max_acc=500)
+#   vehicle.pid.follow_profile(profile)
+#   while not vehicle.pid.target_met():
+#       vehicle.set_motor(*vehicle.pid.run())
+
+
+class TrapezoidalProfile:
+    def __init__(self, distance_mm, max_vel=250, max_acc=500, v_start=0, v_end=0):
+        """Position setpoints for one wheel: accelerate at max_acc (mm/s^2) from v_start up to max_vel (mm/s),
+        cruise, then decelerate to v_end exactly at distance_mm. If the move is too short to ever
+        reach max_vel we get a triangle instead of a trapezoid. Times are in ms (like ticks_ms).
+        v_start and v_end (mm/s, >= 0) let moves run into each other without stopping in between. If the
+        move is too short to get from v_start to v_end, v_end is changed to the closest we can get, so check
+        the v_end attribute for where we actually finish."""
+        self.distance = distance_mm
+        self.sign = 1 if distance_mm >= 0 else -1
+        d = abs(distance_mm)
+
+        # work in mm/ms and mm/ms^2 so we can feed ticks_ms straight in
+        self.acc = max_acc / 1e6
+        self.vel = max_vel / 1e3
+        v0 = min(v_start, max_vel) / 1e3
+        v1 = min(v_end, max_vel) / 1e3
+
+        # we can only change speed so much over d, so the end speed may have to give
+        reachable = 2 * self.acc * d
+        if v1 * v1 > v0 * v0 + reachable:
+            v1 = sqrt(v0 * v0 + reachable)
+        elif v0 * v0 > v1 * v1 + reachable:
+            v1 = sqrt(v0 * v0 - reachable)
+        self.v0 = v0
+        self.v1 = v1
+        self.v_end = v1 * 1e3
+
+        d_acc = (self.vel * self.vel - v0 * v0) / (2 * self.acc)
+        d_dec = (self.vel * self.vel - v1 * v1) / (2 * self.acc)
+        if d_acc + d_dec > d:  # triangular profile -> never reach max_vel
+            self.vel = max(sqrt((reachable + v0 * v0 + v1 * v1) / 2), v0, v1)
+            d_acc = (self.vel * self.vel - v0 * v0) / (2 * self.acc)
+            d_dec = (self.vel * self.vel - v1 * v1) / (2 * self.acc)
+        self.t_acc = (self.vel - v0) / self.acc
+        self.d_acc = d_acc
+        self.t_dec = (self.vel - v1) / self.acc
+        self.t_cruise = max(d - d_acc - d_dec, 0) / self.vel if self.vel > 0 else 0
+        self.duration_ms = self.t_acc + self.t_cruise + self.t_dec
+
+    def position(self, t_ms):
+        """Signed setpoint (mm) at t_ms after the start of the move"""
+        if t_ms <= 0:
+            return 0
+        if t_ms >= self.duration_ms:
+            return self.distance
+        if t_ms < self.t_acc:  # accelerating
+            pos = self.v0 * t_ms + 0.5 * self.acc * t_ms * t_ms
+        elif t_ms < self.t_acc + self.t_cruise:  # cruising
+            pos = self.d_acc + self.vel * (t_ms - self.t_acc)
+        else:  # decelerating
+            t_left = self.duration_ms - t_ms
+            pos = abs(self.distance) - self.v1 * t_left - 0.5 * self.acc * t_left * t_left
+        return self.sign * pos
+
+    def velocity(self, t_ms):
+        """Signed setpoint velocity (mm/s) at t_ms after the start of the move"""
+        if t_ms <= 0:
+            return self.sign * self.v0 * 1e3
+        if t_ms >= self.duration_ms:
+            return self.sign * self.v1 * 1e3
+        if t_ms < self.t_acc:
+            vel = self.v0 + self.acc * t_ms
+        elif t_ms < self.t_acc + self.t_cruise:
+            vel = self.vel
+        else:
+            vel = self.v1 + self.acc * (self.duration_ms - t_ms)
+        return self.sign * vel * 1e3
+
+    def is_finished(self, t_ms):
+        return t_ms >= self.duration_ms
+
+
+class SyncedProfile:
+    def __init__(self, left_mm, right_mm, max_vel=250, max_acc=500, v_start=0, v_end=0):
+        """Position setpoints for both wheels that start and finish together. The wheel with the
+        furthest to go (the 'lead' wheel) gets a TrapezoidalProfile with the given limits, and the
+        other wheel is scaled down from it. This keeps the left:right ratio constant for the whole
+        move, so curves like 300:500 are driven as a curve the entire time. v_start/v_end are the
+        lead wheel's speeds at the start and end (see TrapezoidalProfile)."""
+        self.left_mm = left_mm
+        self.right_mm = right_mm
+        self.lead = TrapezoidalProfile(max(abs(left_mm), abs(right_mm)), max_vel, max_acc, v_start, v_end)
+        self.duration_ms = self.lead.duration_ms
+        self.v_end = self.lead.v_end
+
+    def progress(self, t_ms):
+        """Fraction (0 -> 1) of the move that should be complete at t_ms"""
+        if self.lead.distance == 0:
+            return 1
+        return self.lead.position(t_ms) / self.lead.distance
+
+    def positions(self, t_ms):
+        """Signed (left, right) setpoints in mm at t_ms after the start of the move"""
+        if t_ms >= self.duration_ms:
+            return self.left_mm, self.right_mm
+        p = self.progress(t_ms)
+        return self.left_mm * p, self.right_mm * p
+
+    def velocities(self, t_ms):
+        """Signed (left, right) setpoint velocities in mm/s at t_ms after the start of the move"""
+        if self.lead.distance == 0:
+            return 0, 0
+        v = self.lead.velocity(t_ms) / self.lead.distance
+        return self.left_mm * v, self.right_mm * v
+
+    def is_finished(self, t_ms):
+        return t_ms >= self.duration_ms
@@ -0,0 +1,203 @@
+from math import pi
+from motion_profile import SyncedProfile
+from pid_control import WHEEL_BASE_MM
+
+
+# example use of this module:
+#   from motion_queue import MotionQueue
+#   motion = MotionQueue(vehicle.pid)       # or just use vehicle.motion
+#   motion.straight(40)
+#   motion.turn(-90, gains='rotate')        # on the spot, positive is anticlockwise (left)
+#   motion.arc(130, 90, name="Travelling around")
+#   motion.turn_to(0)                       # face the way we were when the queue started (needs odometry)
+#   while motion.step():                    # one step per control tick, from inside the main loop
+#       vehicle.set_motor(*vehicle.pid.run())
+#       ...                                 # read sensors, check for hazards, update the display, etc.
+
+
+class Manoeuvre:
+    def __init__(self, left_mm, right_mm, max_vel, max_acc, gains, coupled, blend, name, heading=None,
+                 mark=False):
+        """One queued move: how far each wheel goes and the limits to do it with (see MotionQueue.add).
+        If heading is given, it is a turn on the spot to that heading (see MotionQueue.turn_to) and the wheel
+        distances are worked out when it starts. A mark doesn't move, it just remembers the heading"""
+        self.left_mm = left_mm
+        self.right_mm = right_mm
+        self.max_vel = max_vel
+        self.max_acc = max_acc
+        self.gains = gains
+        self.coupled = coupled
+        self.blend = blend
+        self.name = name
+        self.heading = heading
+        self.mark = mark
+        self.tries = 0
+
+
+class MotionQueue:
+    def __init__(self, pid, blend_fraction=0.5, wheel_base_mm=WHEEL_BASE_MM, odometry=None, heading_tolerance=3,
+                 heading_tries=3):
+        """Runs a queue of manoeuvres (straights, arcs, turns on the spot) on a PIDController without blocking:
+        call step() once per control tick and it starts the next manoeuvre when the current one is done.
+        Consecutive manoeuvres that go the same way (neither wheel reverses) are blended: the first one doesn't
+        stop at its end but hands over at blend_fraction of the slower max_vel, so track pieces flow together.
+        With an odometry.Odometry, turn_to can turn to a measured heading rather than by a fixed distance: it
+        turns again (up to heading_tries times in all) until it is within heading_tolerance degrees"""
+        self.pid = pid
+        self.blend_fraction = blend_fraction
+        self.wheel_base = wheel_base_mm
+        self.odometry = odometry
+        self.heading_mark = 0   # heading (radians) at the last mark, see turn_to
+        self.heading_tolerance = heading_tolerance * pi / 180
+        self.heading_tries = heading_tries
+        self.queue = []         # Manoeuvres waiting to start
+        self.current = None     # Manoeuvre we are running
+        self.v_end = 0          # speed (mm/s, lead wheel) the current manoeuvre finishes at
+        self.blending = False   # the current manoeuvre runs straight into the next one, see can_blend
+        self.started = 0        # manoeuvres started since the queue was last empty
+        self.total = 0          # manoeuvres started + waiting, for progress()
+
+    # - - - - - - - - - - - - - - - - - - - - QUEUEING - - - - - - - - - - - - - - - - - - - - #
+    def add(self, left_mm, right_mm, max_vel=250, max_acc=500, gains='default', coupled=True, blend=True,
+            name=None, heading=None):
+        """Queue a move of left_mm/right_mm (like run_pid). gains is the name of a PID gain set, coupled holds
+        the wheels to the left:right ratio, and blend allows running into the next manoeuvre without stopping"""
+        self.queue.append(Manoeuvre(left_mm, right_mm, max_vel, max_acc, gains, coupled, blend, name, heading))
+        self.total += 1
+
+    def straight(self, distance_mm, **kwargs):
+        self.add(distance_mm, distance_mm, **kwargs)
+
+    def arc(self, radius_mm, angle_deg, **kwargs):
+        """Drive around a circle of radius_mm (to the middle of the vehicle) for angle_deg, positive to the
+        left (anticlockwise), negative to the right"""
+        angle = abs(angle_deg) * pi / 180
+        inner = (radius_mm - self.wheel_base / 2) * angle
+        outer = (radius_mm + self.wheel_base / 2) * angle
+        if angle_deg >= 0:
+            self.add(inner, outer, **kwargs)
+        else:
+            self.add(outer, inner, **kwargs)
+
+    def turn(self, angle_deg, **kwargs):
+        """Spin on the spot by angle_deg, positive to the left (anticlockwise)"""
+        distance = self.wheel_base / 2 * angle_deg * pi / 180
+        self.add(-distance, distance, **kwargs)
+
+    def mark_heading(self):
+        """Remember our heading when the queue gets here, later turn_to's are relative to it. The queue is
+        marked when it starts anyway"""
+        self.queue.append(Manoeuvre(0, 0, 0, 0, None, False, False, None, mark=True))
+
+    def turn_to(self, angle_deg, **kwargs):
+        """Spin on the spot to face angle_deg (positive to the left) from the heading at the last mark, as
+        measured by the odometry when the turn starts. Errors in the manoeuvres before it (wheel slip, lag)
+        are turned out rather than adding up"""
+        if self.odometry is None:
+            raise ValueError("turn_to needs odometry to measure our heading")
+        kwargs['blend'] = False
+        self.add(0, 0, heading=angle_deg * pi / 180, **kwargs)
+
+    def clear(self):
+        """Forget everything queued (the current manoeuvre is dropped too, the PID keeps its last target)"""
+        self.queue = []
+        self.current = None
+        self.v_end = 0
+        self.blending = False
+        self.started, self.total = 0, 0
+
+    # - - - - - - - - - - - - - - - - - - - - RUNNING - - - - - - - - - - - - - - - - - - - - #
+    def can_blend(self, current, following):
+        """We can run into the next manoeuvre without stopping if neither wheel has to reverse and the same wheel
+        leads (profiles are in the lead wheel's speed, so a new lead wheel would have its speed step at the
+        handover). We also need to know how far it goes, which we don't for a turn_to until it starts"""
+        if not current.blend or following.heading is not None or following.mark:
+            return False
+        lead = abs(current.left_mm) - abs(current.right_mm)  # > 0 left leads, < 0 right leads, 0 both do
+        following_lead = abs(following.left_mm) - abs(following.right_mm)
+        if lead * following_lead < 0:
+            return False
+        return ((current.left_mm >= 0) == (following.left_mm >= 0)
+                and (current.right_mm >= 0) == (following.right_mm >= 0))
+
+    def take_marks(self):
+        while len(self.queue) > 0 and self.queue[0].mark:
+            self.queue.pop(0)
+            if self.odometry is not None:
+                self.heading_mark = self.odometry.heading
+
+    def start_next(self):
+        manoeuvre = self.queue.pop(0)
+        if manoeuvre.heading is not None:
+            manoeuvre.tries += 1
+            turn = self.odometry.heading_error(self.heading_mark + manoeuvre.heading) * self.wheel_base / 2
+            manoeuvre.left_mm, manoeuvre.right_mm = -turn, turn
+        # we only run into this one if we checked we could when the last one started (a profile that can't slow
+        # down to 0 in time finishes faster, but that doesn't make it a blend)
+        handover = self.current is not None and self.blending
+        blending = len(self.queue) > 0 and self.can_blend(manoeuvre, self.queue[0])
+        v_end = self.blend_fraction * min(manoeuvre.max_vel, self.queue[0].max_vel) if blending else 0
+        v_start = self.v_end if handover else 0
+
+        self.pid.use_gains(manoeuvre.gains)
+        profile = SyncedProfile(manoeuvre.left_mm, manoeuvre.right_mm, manoeuvre.max_vel, manoeuvre.max_acc,
+                                v_start, v_end)
+        if handover:  # the wheels are moving, so keep the loop going (and whatever they lag by)
+            self.pid.hand_over(profile)
+        else:
+            self.pid.follow_profile(profile)
+        if manoeuvre.coupled:
+            self.pid.set_coupling(manoeuvre.left_mm, manoeuvre.right_mm)
+        if manoeuvre.tries <= 1:
+            self.started += 1
+        self.current = manoeuvre
+        self.v_end = profile.v_end
+        self.blending = blending
+
+    def step(self):
+        """Call once per control tick (before pid.run()). Starts the next manoeuvre once the current one is
+        done: when its profile has finished if we are running into the next one, otherwise once the wheels
+        have got there. Returns True while there is anything left to do"""
+        if self.current is None:
+            if self.odometry is not None:
+                self.heading_mark = self.odometry.heading
+            self.take_marks()
+            if len(self.queue) == 0:
+                return False
+            self.start_next()
+            return True
+
+        if self.blending:
+            done = self.pid.profile_finished()
+        else:
+            done = self.pid.target_met()
+        if not done:
+            return True
+        if self.current.heading is not None and self.current.tries < self.heading_tries:
+            error = self.odometry.heading_error(self.heading_mark + self.current.heading)
+            if abs(error) > self.heading_tolerance:  # slipped or overshot, so turn out what is left
+                self.queue.insert(0, self.current)
+                self.start_next()
+                return True
+        self.take_marks()
+        if len(self.queue) > 0:
+            self.start_next()
+            return True
+        self.current = None
+        self.v_end = 0
+        self.blending = False
+        self.started, self.total = 0, 0
+        return False
+
+    def busy(self):
+        return self.current is not None or len(self.queue) > 0
+
+    def name(self):
+        """Name of the current manoeuvre (None if it doesn't have one, or we aren't running one)"""
+        return self.current.name if self.current is not None else None
+
+    def progress(self):
+        """(manoeuvre number (from 1), of how many, fraction of the current one done)"""
+        if self.current is None:
+            return 0, self.total, 0
+        return self.started, self.total, self.pid.profile_progress()
@@ -0,0 +1,137 @@
+# example use of this module:
+#   from motor_model import MotorModel
+#   model = MotorModel()
+#   model.load_offsets('motor.txt')        # or model.set_offsets(duties, offsets)
+#   model.load_speeds('motor_speed.txt')   # or model.set_speeds(duties, left, right)
+#   pid.set_motor_model(model)
+# (Vehicle keeps the tables in its CalibrationStore and uses set_offsets/set_speeds)
+
+
+def interpolate(x, xs, ys):
+    """Linearly interpolates y at x from a table of xs (ascending) -> ys. Clamps to the ends of the table"""
+    if x <= xs[0]:
+        return ys[0]
+    if x >= xs[-1]:
+        return ys[-1]
+    # binary search for the pair of entries either side of x
+    lo, hi = 0, len(xs) - 1
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if xs[mid] <= x:
+            lo = mid
+        else:
+            hi = mid
+    return ys[lo] + (ys[hi] - ys[lo]) * (x - xs[lo]) / (xs[hi] - xs[lo])
+
+
+def read_table(filename):
+    """Reads a csv file with a header line into a list of columns (lists of ints). Raises OSError if the
+    file is missing and ValueError if it is badly formatted"""
+    f = open(filename, 'r')
+    lines = f.read().split('\n')[1:]  # skip the header
+    f.close()
+    columns = None
+    for line in lines:
+        if line.strip() == "":
+            continue
+        values = [int(value) for value in line.split(',')]
+        if columns is None:
+            columns = [[] for _ in values]
+        for i in range(0, len(values)):
+            columns[i].append(values[i])
+    if columns is None:
+        raise ValueError("{} has no data".format(filename))
+    return columns
+
+
+class MotorModel:
+    def __init__(self, deadband=30, bias=3, ff_gain=0.1):
+        """A model of how the motors respond to duty, used by PIDController as feed-forward so the PID
+        only has to correct what the model gets wrong. Defaults match the old fixed min_duty_trim/bias.
+        - deadband: duty (per side) below which the motor doesn't turn
+        - bias: duty taken from the left and given to the right motor to make them match
+        - ff_gain: duty per mm/s above the deadband, used when we have no speed table"""
+        self.deadband_left = deadband
+        self.deadband_right = deadband
+        self.bias = bias
+        self.ff_gain = ff_gain
+
+        # duty -> offset table, measured by Vehicle.motor_calibration()
+        self.offset_duties = None
+        self.offsets = None
+
+        # measured speed (mm/s) -> duty tables per side, built from Vehicle.motor_speed_calibration()
+        self.speeds_left, self.duties_left = None, None
+        self.speeds_right, self.duties_right = None, None
+
+    def load_offsets(self, filename='motor.txt'):
+        """Loads a 'speed,offset' table. Returns True if it was loaded"""
+        try:
+            self.set_offsets(*read_table(filename)[0:2])
+        except (OSError, ValueError, TypeError):
+            return False
+        return True
+
+    def load_speeds(self, filename='motor_speed.txt'):
+        """Loads a 'duty,left,right' table of measured wheel speeds (mm/s). Returns True if it was loaded"""
+        try:
+            self.set_speeds(*read_table(filename)[0:3])
+        except (OSError, ValueError, TypeError):
+            return False
+        return True
+
+    def set_offsets(self, duties, offsets):
+        """Use a duty -> offset table (duties ascending)"""
+        self.offset_duties, self.offsets = duties, offsets
+
+    def set_speeds(self, duties, left, right):
+        """Use a table of measured wheel speeds (mm/s) at each duty. The deadbands are taken as the largest
+        duty that didn't move each wheel"""
+        self.deadband_left = self.stall_duty(duties, left)
+        self.deadband_right = self.stall_duty(duties, right)
+        self.speeds_left, self.duties_left = self.inverse_table(duties, left)
+        self.speeds_right, self.duties_right = self.inverse_table(duties, right)
+
+    @staticmethod
+    def stall_duty(duties, speeds):
+        stall = 0
+        for i in range(0, len(duties)):
+            if speeds[i] <= 0:
+                stall = duties[i]
+        return stall
+
+    @staticmethod
+    def inverse_table(duties, speeds):
+        """Builds a speed -> duty table from a duty -> speed table, keeping only the entries where the
+        wheel moves and gets faster (so the speeds are ascending, which interpolate() needs)"""
+        inv_speeds, inv_duties = [], []
+        for i in range(0, len(duties)):
+            if speeds[i] > 0 and (len(inv_speeds) == 0 or speeds[i] > inv_speeds[-1]):
+                inv_speeds.append(speeds[i])
+                inv_duties.append(duties[i])
+        if len(inv_speeds) < 2:
+            return None, None
+        return inv_speeds, inv_duties
+
+    def offset(self, duty):
+        """Duty to take from the left and give to the right motor at a given (positive) duty"""
+        if self.offset_duties is None:
+            return self.bias
+        return interpolate(duty, self.offset_duties, self.offsets)
+
+    def feed_forward(self, mm_s, deadband, speeds, duties):
+        """Duty above the deadband needed to travel at mm_s, signed"""
+        speed = abs(mm_s)
+        if speed == 0:
+            return 0
+        if speeds is None:  # no speed table, so assume duty is proportional to speed
+            duty = self.ff_gain * speed
+        else:
+            duty = interpolate(speed, speeds, duties) - deadband
+        return duty if mm_s > 0 else -duty
+
+    def feed_forward_left(self, mm_s):
+        return self.feed_forward(mm_s, self.deadband_left, self.speeds_left, self.duties_left)
+
+    def feed_forward_right(self, mm_s):
+        return self.feed_forward(mm_s, self.deadband_right, self.speeds_right, self.duties_right)
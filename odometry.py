@@ -0,0 +1,83 @@
+from math import sin, cos, atan2, sqrt, pi
+from pid_control import MM_PER_CLICK, WHEEL_BASE_MM
+
+
+# example use of this module:
+#   from odometry import Odometry
+#   odometry = Odometry(vehicle.encoder)   # or just use vehicle.odometry, which main() keeps updated
+#   while True:
+#       vehicle.set_motor(*vehicle.pid.run())
+#       odometry.update()                  # once per control tick
+#       x, y = odometry.x, odometry.y      # mm from where we started, x is the way we were facing
+#       print(odometry.heading_deg())      # degrees anticlockwise (left) from where we were facing
+#
+# NOTE: this is dead reckoning, wheel slip (e.g. spinning on the spot) adds up. Use it for relative moves like
+#       "face 90 degrees left of where we came in", not to find our way around the whole track
+
+
+def wrap_angle(angle):
+    """An angle (radians) in -pi -> pi"""
+    while angle > pi:
+        angle -= 2 * pi
+    while angle <= -pi:
+        angle += 2 * pi
+    return angle
+
+
+class Odometry:
+    def __init__(self, encoder, wheel_base_mm=WHEEL_BASE_MM, mm_per_click=MM_PER_CLICK):
+        """Tracks the vehicle's pose (x, y in mm and heading in radians, anticlockwise positive) from the
+        encoder totals (EncoderClicker.get_total_*, which keep counting when the PID clears its counts).
+        Each update() moves the pose by how far each wheel went since the last one, as a differential drive
+        with the given distance between the wheels. The queries just read the pose, so they are cheap"""
+        self.encoder = encoder
+        self.wheel_base = wheel_base_mm
+        self.mm_per_click = mm_per_click
+        self.reset()
+
+    def reset(self, x=0, y=0, heading=0):
+        """Start counting from this pose (heading in radians)"""
+        self.x, self.y, self.heading = x, y, heading
+        self.distance = 0  # mm travelled by the middle of the vehicle, forwards or backwards
+        self.total_left = self.encoder.get_total_left()
+        self.total_right = self.encoder.get_total_right()
+
+    def update(self):
+        """Move the pose on by the clicks since the last update. Call this once per control tick"""
+        total_left = self.encoder.get_total_left()
+        total_right = self.encoder.get_total_right()
+        clicks_left = total_left - self.total_left
+        clicks_right = total_right - self.total_right
+        if clicks_left == 0 and clicks_right == 0:
+            return  # haven't moved, don't bother with the trig
+        self.total_left, self.total_right = total_left, total_right
+
+        mm_left = clicks_left * self.mm_per_click
+        mm_right = clicks_right * self.mm_per_click
+        forward = (mm_left + mm_right) / 2
+        turn = (mm_right - mm_left) / self.wheel_base
+
+        # travel along the average heading over the step, which is exact for an arc's chord direction
+        mid_heading = self.heading + turn / 2
+        self.x += forward * cos(mid_heading)
+        self.y += forward * sin(mid_heading)
+        self.heading = wrap_angle(self.heading + turn)
+        self.distance += abs(forward)
+
+    # - - - - - - - - - - - - - - - - - - - - QUERIES - - - - - - - - - - - - - - - - - - - - #
+    def pose(self):
+        return self.x, self.y, self.heading
+
+    def heading_deg(self):
+        return self.heading * 180 / pi
+
+    def heading_error(self, heading):
+        """How far (radians, -pi -> pi) we would have to turn anticlockwise to face heading"""
+        return wrap_angle(heading - self.heading)
+
+    def distance_to(self, x, y):
+        return sqrt((x - self.x) ** 2 + (y - self.y) ** 2)
+
+    def bearing_to(self, x, y):
+        """How far (radians, -pi -> pi) we would have to turn anticlockwise to face the point x, y"""
+        return self.heading_error(atan2(y - self.y, x - self.x))
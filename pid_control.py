@@ -1,4 +1,8 @@
 from time import ticks_ms, ticks_diff, sleep_ms
+from motor_model import MotorModel
+
+MM_PER_CLICK = 3.1416 * 65 / 40  # wheel circumference / clicks per revolution
+WHEEL_BASE_MM = 110              # distance between the wheels (roughly, a -86:86 spin is a quarter turn)
 
 
 def mm_to_clicks(mm):
@@ -24,12 +28,59 @@ def clamp(duty, max_duty, min_duty):
 
 
 class PIDController:
-    def __init__(self, encoder, target_mm_left=0, target_mm_right=0, kp=1.15, ki=0.0001, kd=10):
+    def __init__(self, encoder, target_mm_left=0, target_mm_right=0, kp=1.15, ki=0.0001, kd=10, motor_model=None):
         """initialise all PID controller constants, variables, and encoder object"""
-        # initialise target and encoder object
+        self.encoder = encoder
+
+        # feed-forward motor model: deadbands, left/right offsets and duty for a given speed
+        self.motor_model = motor_model if motor_model is not None else MotorModel()
+
+        # proportionality constants: P = proportional, I = integral, D = derivative
+        self.KP = kp  # motor_duty is proportional to (click error * KP) plus...
+        self.KI = ki  # motor_duty is proportional to (sum of click error * KI) plus...
+        self.KD = kd  # motor_duty is proportional to (projected click error * KD)
+
+        # clamp constants
+        self.max_duty = 45  # effective max is deadband + max_duty = ~75
+        self.min_duty = -45  # effective min is -deadband + min_duty = ~-75
+        self.max_integral = 10
+        self.min_integral = -10
+        self.max_overshoot = 8
+
+        # velocity mode constants: an outer position loop nudges the commanded speed, and an inner loop turns
+        # speed error (mm/s) into duty on top of the motor model's feed-forward duty for the commanded speed
+        self.KV_P = 0.05  # motor_duty is proportional to (mm/s error * KV_P) plus...
+        self.KV_I = 0.0001  # motor_duty is proportional to (sum of mm/s error * KV_I)
+        self.KV_POS = 5  # outer loop: commanded mm/s is corrected by (clicks behind * KV_POS)...
+        self.max_vel_correction = 50  # ...up to this many mm/s either way
+        self.vel_window_ms = 50  # measure speed over at least this long, we only get ~5mm per click
+
+        # cross-coupling constant: motor_duty is shifted between the wheels by (sync click error * KC)
+        self.KC = 0.5
+
+        # proportional on measurement (clicks input) option
+        self.p_on_m = False
+        # derivative on output (motor duty) option
+        self.d_on_o = False
+
+        # print csv data over serial every run() (the first thing to go when the loop is running late)
+        self.telemetry = True
+
+        # gain schedule: named sets of constants we can switch between (see add_gain_set and use_gains)
+        self.gain_sets = {}
+        self.gain_set = None
+        self.gain_scales = {}  # name -> (kp, ki, kd) scales of sets that follow 'default' (see add_scaled_gain_set)
+        self.add_gain_set('default', kp, ki, kd)
+        self.use_gains('default')
+
+        # initialise target, encoder polarity and PID variables
+        self.set_target(target_mm_left, target_mm_right)
+
+    def set_target(self, target_mm_left, target_mm_right):
+        """Reset PID control with a new target (keeps the current constants)"""
+        # initialise target
         self.target_clicks_left = mm_to_clicks(target_mm_left)
         self.target_clicks_right = mm_to_clicks(target_mm_right)
-        self.encoder = encoder
 
         # encoder polarity is true for a forwards/zero target, and false for a backwards target
         encoder_polarity_left = self.target_clicks_left >= 0
@@ -53,39 +104,168 @@ class PIDController:
         self.t0 = ticks_ms()
         self.dt = 0
         self.click_left, self.click_right = 0, 0
-
-        # proportionality constants: P = proportional, I = integral, D = derivative
-        self.KP = kp  # motor_duty is proportional to (click error * KP) plus...
-        self.KI = ki  # motor_duty is proportional to (sum of click error * KI) plus...
-        self.KD = kd  # motor_duty is proportional to (projected click error * KD)
-
-        # clamp and bias constants
-        self.min_duty_trim = 30  # anything between -35pwm to +35pwm doesn't move; so add this to all duties
-        self.max_duty = 45  # effective max is min_duty_trim + max_duty = 75
-        self.min_duty = -45  # effective min is -min_duty_trim + min_duty = -75
-        self.max_integral = 10
-        self.min_integral = -10
-        self.max_overshoot = 8
-        self.bias = 3
-
-        # proportional on measurement (clicks input) option
-        self.p_on_m = False
-        # derivative on output (motor duty) option
-        self.d_on_o = False
-
-    def set_target(self, target_mm_left, target_mm_right):
-        """Reset PID control with a new target"""
-        self.__init__(self.encoder, target_mm_left, target_mm_right)
+        self.prev_click_left, self.prev_click_right = 0, 0
+
+        # moving setpoints (see follow_profile), None means we jump straight to the target
+        self.profile = None
+        self.profile_t0 = self.t0
+        self.profile_base_left, self.profile_base_right = 0, 0  # clicks the profile starts from, see hand_over
+        self.feed_forward_left, self.feed_forward_right = 0, 0
+
+        # cross-coupling between the wheels (see set_coupling), off until asked for
+        self.coupled = False
+        self.ratio_left, self.ratio_right = 1, 1
+        self.sync_click0_left, self.sync_click0_right = 0, 0
+        self.sync_error = 0
+        self.sync_error0 = 0  # sync error carried over from before the ratio last changed
+
+        # velocity mode variables (see set_velocity)
+        self.velocity_mode = False
+        self.target_vel_left, self.target_vel_right = 0, 0  # mm/s
+        self.vel_left, self.vel_right = 0, 0  # measured mm/s
+        self.vel_t0 = self.t0
+        self.vel_click0_left, self.vel_click0_right = 0, 0
+        self.setpoint_clicks_left, self.setpoint_clicks_right = 0, 0  # where we would be at the commanded speed
+
+    def set_motor_model(self, motor_model):
+        """Use a different motor model (e.g. one loaded from calibration files) for feed-forward"""
+        self.motor_model = motor_model
+
+    def add_gain_set(self, name, kp, ki, kd, kv_p=None, kv_i=None, max_duty=None, min_duty=None,
+                     max_integral=None, min_integral=None):
+        """Add (or replace) a named set of constants. Anything left as None is copied from the current
+        constants. Different manoeuvres have very different dynamics, e.g. cruising vs spinning on the spot"""
+        self.gain_sets[name] = (kp, ki, kd,
+                                self.KV_P if kv_p is None else kv_p,
+                                self.KV_I if kv_i is None else kv_i,
+                                self.max_duty if max_duty is None else max_duty,
+                                self.min_duty if min_duty is None else min_duty,
+                                self.max_integral if max_integral is None else max_integral,
+                                self.min_integral if min_integral is None else min_integral)
+        if name == self.gain_set:
+            self.gain_set = None
+            self.use_gains(name)
+
+    def add_scaled_gain_set(self, name, kp_scale, ki_scale, kd_scale, *limits):
+        """Add a named set whose kp/ki/kd are scales of the 'default' set's, so they follow it when it is
+        (auto)tuned. limits are the rest of add_gain_set's arguments (kv_p, kv_i, max_duty, ...)"""
+        self.gain_scales[name] = (kp_scale, ki_scale, kd_scale)
+        kp, ki, kd = self.gain_sets['default'][:3]
+        self.add_gain_set(name, kp * kp_scale, ki * ki_scale, kd * kd_scale, *limits)
+
+    def use_gains(self, name):
+        """Switch to a named set of constants. Doesn't touch the target, so it is safe mid-move"""
+        if name == self.gain_set:
+            return
+        (self.KP, self.KI, self.KD, self.KV_P, self.KV_I,
+         self.max_duty, self.min_duty, self.max_integral, self.min_integral) = self.gain_sets[name]
+        self.gain_set = name
+
+    def set_gains(self, kp, ki, kd, name='default'):
+        """Change the PID constants of a gain set (keeping its limits) without touching the current target.
+        Changing 'default' changes the sets scaled from it too"""
+        gains = self.gain_sets[name]
+        self.add_gain_set(name, kp, ki, kd, *gains[3:])
+        if name == 'default':  # the scaled sets follow it
+            for scaled in self.gain_scales:
+                kp_scale, ki_scale, kd_scale = self.gain_scales[scaled]
+                gains = self.gain_sets[scaled]
+                self.add_gain_set(scaled, kp * kp_scale, ki * ki_scale, kd * kd_scale, *gains[3:])
 
     def reset(self, target_mm_left, target_mm_right, kp, ki, kd):
         """Reset PID control with a new target and constants"""
-        self.__init__(self.encoder, target_mm_left, target_mm_right, kp, ki, kd)
+        self.KP, self.KI, self.KD = kp, ki, kd
+        self.gain_set = None  # we are no longer using any of the named sets
+        self.set_target(target_mm_left, target_mm_right)
+
+    def follow_profile(self, profile):
+        """Reset PID control to track the moving setpoints of a motion profile (e.g. a
+        motion_profile.SyncedProfile) instead of jumping straight to the final target. The
+        targets start at zero and are advanced along the profile every time we run()"""
+        self.set_target(profile.left_mm, profile.right_mm)  # sets encoder polarity from the final target
+        self.target_clicks_left, self.target_clicks_right = 0, 0
+        self.profile = profile
+        self.profile_t0 = ticks_ms()
+
+    def hand_over(self, profile):
+        """Run straight on from the current profile into the next one without stopping. Unlike follow_profile
+        nothing is reset (encoder counts, integral, duty, ...): the new profile starts where the last one's
+        setpoints finished, so however far the wheels lag behind is carried over too. Only for a move that
+        turns each wheel the same way as the last one did, as the encoder polarity stays as it is"""
+        if self.profile is not None:
+            self.profile_base_left += mm_to_clicks(self.profile.left_mm)
+            self.profile_base_right += mm_to_clicks(self.profile.right_mm)
+        self.profile = profile
+        self.profile_t0 = ticks_ms()
+
+    def set_velocity(self, mm_s_left, mm_s_right):
+        """Drive the wheels at a constant speed (mm/s) instead of to a position. Call this as often as you
+        like, e.g. every loop to steer, as only the first call resets the controller. Use set_target (or
+        follow_profile) to go back to position control"""
+        if not self.velocity_mode:
+            self.set_target(0, 0)
+            self.encoder.set_left_dir(mm_s_left >= 0)
+            self.encoder.set_right_dir(mm_s_right >= 0)
+            self.enc_left_is_fwd, self.enc_right_is_fwd = mm_s_left >= 0, mm_s_right >= 0
+            self.velocity_mode = True
+        # keep the wheels coupled at the new ratio if we are steering, without forgetting how far out they are
+        if self.coupled and mm_s_left * self.ratio_right != mm_s_right * self.ratio_left:
+            self.set_coupling(mm_s_left, mm_s_right, keep_error=True)
+        self.target_vel_left, self.target_vel_right = mm_s_left, mm_s_right
+
+    def set_coupling(self, ratio_left, ratio_right, kc=None, keep_error=False):
+        """Couple the wheels so that their progress (from now on) stays at ratio_left:ratio_right, e.g. 1:1 for
+        straight, 300:500 for a gentle curve or -1:1 to spin on the spot. Any left/right mismatch that would
+        otherwise show up as heading drift is corrected by moving duty from the wheel that is ahead to the one
+        that is behind. Lasts until the next set_target/follow_profile; in velocity mode set_velocity keeps
+        the ratio up to date. keep_error carries the current sync error over to the new ratio rather than
+        starting again from zero, so steering a little every tick doesn't switch the coupling off"""
+        self.sync_error0 = self.sync_error if keep_error and self.coupled else 0
+        self.coupled = True
+        self.ratio_left, self.ratio_right = ratio_left, ratio_right
+        self.sync_click0_left, self.sync_click0_right = self.encoder.get_left(), self.encoder.get_right()
+        if kc is not None:
+            self.KC = kc
+
+    def clear_coupling(self):
+        self.coupled = False
+        self.sync_error = 0
+        self.sync_error0 = 0
+
+    def update_profile(self):
+        """Move the targets along to where the motion profile says we should be by now"""
+        elapsed = ticks_diff(ticks_ms(), self.profile_t0)
+        target_mm_left, target_mm_right = self.profile.positions(elapsed)
+        self.target_clicks_left = self.profile_base_left + mm_to_clicks(target_mm_left)
+        self.target_clicks_right = self.profile_base_right + mm_to_clicks(target_mm_right)
+
+        # we also know how fast we should be going, so the motor model can do most of the work
+        vel_left, vel_right = self.profile.velocities(elapsed)
+        self.feed_forward_left = self.motor_model.feed_forward_left(vel_left)
+        self.feed_forward_right = self.motor_model.feed_forward_right(vel_right)
+
+    def profile_finished(self):
+        """True once the motion profile's setpoints have reached the target (or if we aren't following one).
+        The wheels may still be catching up, see target_met"""
+        return self.profile is None or self.profile.is_finished(ticks_diff(ticks_ms(), self.profile_t0))
+
+    def profile_progress(self):
+        """Fraction (0 -> 1) of the motion profile the setpoints have covered"""
+        if self.profile is None:
+            return 1
+        return self.profile.progress(ticks_diff(ticks_ms(), self.profile_t0))
 
     def add_target(self, target_mm_left, target_mm_right):
         self.target_clicks_left += mm_to_clicks(target_mm_left)
         self.target_clicks_right += mm_to_clicks(target_mm_right)
 
     def target_met(self):
+        if self.velocity_mode:
+            return False  # we never arrive anywhere in velocity mode, we just keep driving
+
+        if self.profile is not None and not self.profile.is_finished(ticks_diff(ticks_ms(), self.profile_t0)):
+            return False  # still travelling along the profile
+
         target_met = True
         if self.target_clicks_left >= 0:
             if self.click_left < self.target_clicks_left:
@@ -103,31 +283,43 @@ class PIDController:
 
     def run(self):
         """Calculates the pwm values using PID control (a closed feedback loop)"""
-        self.update_pid()
+        if self.velocity_mode:
+            self.update_velocity_pid()
+        else:
+            self.update_pid()
+        if self.coupled:
+            self.coupling()
         self.update_encoder()
-        self.print_csv_data()
+        if self.telemetry:
+            self.print_csv_data()
         return self.duty_correction()
 
     def duty_correction(self):
-        """First correction: Add a trim to the duties because there is a portion of duty between
-        25 and -25 that effectively does nothing, creating noise in our PID system.
-        Second correction: Fixed bias to correct the motor inbalance.
-        Note: a positive bias means we need to increase power to the right motor,
+        """First correction: Add the motor model's deadband to the duties because there is a portion of duty
+        around zero that effectively does nothing, creating noise in our PID system.
+        Second correction: Offset to correct the motor inbalance at this duty.
+        Note: a positive offset means we need to increase power to the right motor,
         and decrease power to the left motor"""
-        # trim correction
+        model = self.motor_model
+
+        # deadband and offset correction
         if self.duty_left > 0:
-            self.duty_left += self.min_duty_trim
+            self.duty_left += model.deadband_left
+            self.duty_left -= model.offset(self.duty_left)
         elif self.duty_left < 0:
-            self.duty_left -= self.min_duty_trim
+            self.duty_left -= model.deadband_left
+            self.duty_left += model.offset(-self.duty_left)
         # else if duty == 0, leave it alone
 
         if self.duty_right > 0:
-            self.duty_right += self.min_duty_trim
+            self.duty_right += model.deadband_right
+            self.duty_right += model.offset(self.duty_right)
         elif self.duty_right < 0:
-            self.duty_right -= self.min_duty_trim
+            self.duty_right -= model.deadband_right
+            self.duty_right -= model.offset(-self.duty_right)
         # else if duty == 0, leave it alone
 
-        return int(self.duty_left - self.bias), int(self.duty_right + self.bias)
+        return self.duty_left, self.duty_right  # not rounded, the motors take fractional duties
 
     def proportional(self):
         """Calculates the proportional part of PID control"""
@@ -176,6 +368,25 @@ class PIDController:
             self.integral_right = 0
             print("overshoot_right = {}".format(self.overshoot_right))
 
+    def coupling(self):
+        """Calculates the cross-coupling (synchronisation) part of control. The sync error is zero when the
+        clicks travelled by each wheel are in the ratio ratio_left:ratio_right, and we push each wheel's duty
+        in the direction that shrinks it"""
+        scale = max(abs(self.ratio_left), abs(self.ratio_right))
+        if scale == 0:
+            return
+        progress_left = self.click_left - self.sync_click0_left
+        progress_right = self.click_right - self.sync_click0_right
+        self.sync_error = (self.sync_error0
+                           + (progress_left * self.ratio_right - progress_right * self.ratio_left) / scale)
+
+        correction = self.KC * self.sync_error / scale
+        # a wheel told to stop in velocity mode stays stopped (see velocity_duty), the other one does the syncing
+        if not (self.velocity_mode and self.target_vel_left == 0):
+            self.duty_left = clamp(self.duty_left - correction * self.ratio_right, self.max_duty, self.min_duty)
+        if not (self.velocity_mode and self.target_vel_right == 0):
+            self.duty_right = clamp(self.duty_right + correction * self.ratio_left, self.max_duty, self.min_duty)
+
     def update_elapsed_time(self):
         """Calculates the elapsed time, dt, since the last call. Also resets self.t0"""
         t1 = ticks_ms()
@@ -189,6 +400,11 @@ class PIDController:
         # save old errors for integral section
         self.prev_error_left = self.error_left
         self.prev_error_right = self.error_right
+        self.prev_click_left, self.prev_click_right = self.click_left, self.click_right
+
+        # advance moving setpoints
+        if self.profile is not None:
+            self.update_profile()
 
         # calculate current error
         self.click_left, self.click_right = self.encoder.get_left(), self.encoder.get_right()
@@ -201,12 +417,61 @@ class PIDController:
         self.derivative()
         # self.overshoot_reduction()
 
-        # calculate duties
-        self.duty_left = self.proportional_left + self.integral_left - self.derivative_left - self.overshoot_left
-        self.duty_right = self.proportional_right + self.integral_right - self.derivative_right - self.overshoot_right
+        # calculate duties (the feed-forward is only non-zero while following a profile)
+        self.duty_left = (self.feed_forward_left + self.proportional_left + self.integral_left -
+                          self.derivative_left - self.overshoot_left)
+        self.duty_right = (self.feed_forward_right + self.proportional_right + self.integral_right -
+                           self.derivative_right - self.overshoot_right)
         self.duty_left = clamp(self.duty_left, self.max_duty, self.min_duty)
         self.duty_right = clamp(self.duty_right, self.max_duty, self.min_duty)
 
+    def measure_velocity(self):
+        """Updates the measured wheel speeds (mm/s) once at least vel_window_ms has passed"""
+        elapsed = ticks_diff(ticks_ms(), self.vel_t0)
+        if elapsed >= self.vel_window_ms:
+            self.vel_left = (self.click_left - self.vel_click0_left) * MM_PER_CLICK * 1000 / elapsed
+            self.vel_right = (self.click_right - self.vel_click0_right) * MM_PER_CLICK * 1000 / elapsed
+            self.vel_t0 = ticks_ms()
+            self.vel_click0_left, self.vel_click0_right = self.click_left, self.click_right
+
+    def velocity_command(self, target_vel, setpoint_clicks, clicks):
+        """Outer loop: speed up (or slow down) if we have fallen behind (or got ahead of) where the
+        commanded speed should have got us"""
+        return target_vel + clamp((setpoint_clicks - clicks) * self.KV_POS,
+                                  self.max_vel_correction, -self.max_vel_correction)
+
+    def velocity_duty(self, target_vel, vel_cmd, vel, feed_forward, integral):
+        """Inner loop: calculates (duty, proportional, integral) for one wheel in velocity mode"""
+        if target_vel == 0:  # just stop, don't fight to hold position
+            return 0, 0, 0
+
+        error = vel_cmd - vel
+        proportional = self.KV_P * error
+        integral = clamp(integral + self.KV_I * error * self.dt, self.max_integral, self.min_integral)
+        duty = clamp(feed_forward + proportional + integral, self.max_duty, self.min_duty)
+        return duty, proportional, integral
+
+    def update_velocity_pid(self):
+        """Calculates the speed error terms and duties in velocity mode"""
+        self.update_elapsed_time()
+        self.prev_click_left, self.prev_click_right = self.click_left, self.click_right
+        self.click_left, self.click_right = self.encoder.get_left(), self.encoder.get_right()
+        self.measure_velocity()
+
+        # advance where we should be if we were exactly at the commanded speed
+        self.setpoint_clicks_left += self.target_vel_left * self.dt / (1000 * MM_PER_CLICK)
+        self.setpoint_clicks_right += self.target_vel_right * self.dt / (1000 * MM_PER_CLICK)
+
+        vel_cmd_left = self.velocity_command(self.target_vel_left, self.setpoint_clicks_left, self.click_left)
+        vel_cmd_right = self.velocity_command(self.target_vel_right, self.setpoint_clicks_right, self.click_right)
+        self.feed_forward_left = self.motor_model.feed_forward_left(vel_cmd_left)
+        self.feed_forward_right = self.motor_model.feed_forward_right(vel_cmd_right)
+
+        self.duty_left, self.proportional_left, self.integral_left = self.velocity_duty(
+            self.target_vel_left, vel_cmd_left, self.vel_left, self.feed_forward_left, self.integral_left)
+        self.duty_right, self.proportional_right, self.integral_right = self.velocity_duty(
+            self.target_vel_right, vel_cmd_right, self.vel_right, self.feed_forward_right, self.integral_right)
+
     def update_encoder(self):
         """if pwm polarity changes, we must change the encoder count direction,
         however, we need to stop the vehicle first since the encoder will count backwards
@@ -237,16 +502,16 @@ class PIDController:
         if self.toggle_left_enc:
             # overwrite any duties
             self.duty_left = 0
-            # wait until vehicle is stationary
-            if self.click_left + self.prev_error_left - self.target_clicks_left == 0:
+            # wait until vehicle is stationary (no clicks since the last run)
+            if self.click_left == self.prev_click_left:
                 self.encoder.toggle_left_dir()
                 self.toggle_left_enc = False
 
         if self.toggle_right_enc:
             # overwrite any duties
             self.duty_right = 0
-            # wait until vehicle is stationary
-            if self.click_right + self.prev_error_right - self.target_clicks_right == 0:
+            # wait until vehicle is stationary (no clicks since the last run)
+            if self.click_right == self.prev_click_right:
                 self.encoder.toggle_right_dir()
                 self.toggle_right_enc = False
 
@@ -0,0 +1,150 @@
+from time import ticks_ms, ticks_diff
+from math import pi
+from pid_control import WHEEL_BASE_MM
+from odometry import wrap_angle
+
+# example use of this module:
+#   from reacquire import Reacquirer, last_road_side, SEARCHING, FOUND
+#   search = Reacquirer(vehicle.pid, vehicle.odometry)
+#   search.start(last_road_side(vehicle.ir_l_sampler, vehicle.ir_r_sampler))
+#   while search.step(not vehicle.line.lost) == SEARCHING:   # after vehicle.line.update(...)
+#       vehicle.set_motor(*vehicle.pid.run())
+#       vehicle.odometry.update()
+#   ...                                  # follow the line, and once we have held it for a while:
+#   search.confirm()
+#   search.report()                      # how long it usually takes us to find the road again
+
+LEFT = 1    # sides, also the sign of an anticlockwise turn towards them
+RIGHT = -1
+
+SEARCHING = 0   # what step() returns
+FOUND = 1
+GAVE_UP = 2
+
+SWEEP_TOWARDS = 0   # search phases
+SWEEP_BACK = 1
+SPIRAL = 2
+PHASE_NAMES = ("sweep towards", "sweep back", "spiral")
+
+
+def last_road_side(ir_l_sampler, ir_r_sampler):
+    """Which side last saw the road, from the IRSamplers: one that is still on the road, otherwise the one
+    that went off it most recently"""
+    if ir_l_sampler.on_road != ir_r_sampler.on_road:
+        return LEFT if ir_l_sampler.on_road else RIGHT
+    return LEFT if ticks_diff(ir_l_sampler.edge_ms, ir_r_sampler.edge_ms) >= 0 else RIGHT
+
+
+class Reacquirer:
+    def __init__(self, pid, odometry, sweep_deg=70, spin_speed=120, spiral_speed=200, spiral_r0=60,
+                 spiral_growth=25, timeout_ms=20000, wheel_base_mm=WHEEL_BASE_MM):
+        """Searches for the road after we have lost it, driving the PID in velocity mode one step at a time:
+            1. spin towards the side that last saw the road until we have turned sweep_deg (most losses are
+               just the road curving away from us, so it is usually right there)
+            2. spin back the other way to sweep_deg past where we started, in case we guessed wrong
+            3. drive an expanding spiral (curling towards the same side) that starts at spiral_r0 mm radius and
+               grows spiral_growth mm for every radian we turn, until timeout_ms
+        Speeds are mm/s. Headings come from the odometry, so slip doesn't shrink the sweeps.
+        Finding the road only counts once line following has held it (see confirm): if we lose it again before
+        then, start() carries on the same search, so its clock (and timeout_ms) keeps running. Keeps the time
+        each confirmed search took, see mean_ms and report"""
+        self.pid = pid
+        self.odometry = odometry
+        self.sweep = sweep_deg * pi / 180
+        self.spin_speed = spin_speed
+        self.spiral_speed = spiral_speed
+        self.spiral_r0 = spiral_r0
+        self.spiral_growth = spiral_growth
+        self.timeout_ms = timeout_ms
+        self.half_base = wheel_base_mm / 2
+
+        self.side = LEFT
+        self.phase = SWEEP_TOWARDS
+        self.heading0 = 0       # heading when the search started
+        self.turned = 0         # radians turned since the spiral started
+        self.prev_heading = 0
+        self.t0 = ticks_ms()
+        self.searching = False  # a search has started and its find hasn't been confirmed yet
+        self.found_ms = 0       # how long the search had taken when it last found the road
+
+        # search times (ms) of the searches that found the road
+        self.searches = 0
+        self.found = 0
+        self.total_ms = 0
+        self.worst_ms = 0
+
+    def start(self, side):
+        """Start searching, first towards side (LEFT or RIGHT, see last_road_side). If the last search's find
+        wasn't confirmed, this is the same search carrying on: the sweeps start again but the clock doesn't"""
+        self.side = side
+        self.heading0 = self.odometry.heading
+        if not self.searching:
+            self.t0 = ticks_ms()
+            self.searches += 1
+            self.searching = True
+        self.set_phase(SWEEP_TOWARDS)
+
+    def confirm(self):
+        """Line following has held the road, so the search really found it: count how long it took. Cheap to
+        call every tick"""
+        if self.searching:
+            self.searching = False
+            self.found += 1
+            self.total_ms += self.found_ms
+            self.worst_ms = max(self.worst_ms, self.found_ms)
+
+    def set_phase(self, phase):
+        self.phase = phase
+        if phase == SPIRAL:
+            self.turned = 0
+            self.prev_heading = self.odometry.heading
+        else:
+            spin = self.spin_speed * (self.side if phase == SWEEP_TOWARDS else -self.side)
+            self.pid.set_velocity(-spin, spin)
+
+    def elapsed_ms(self):
+        return ticks_diff(ticks_ms(), self.t0)
+
+    def step(self, found):
+        """Call once per control tick (before pid.run()) with whether we can see the road (use the same test as
+        line following, e.g. not LineEstimator.lost). Returns FOUND as soon as we can, GAVE_UP once the search has
+        taken timeout_ms, otherwise SEARCHING"""
+        if found:
+            self.found_ms = self.elapsed_ms()
+            return FOUND
+        if self.elapsed_ms() > self.timeout_ms:
+            self.searching = False
+            return GAVE_UP
+
+        if self.phase == SWEEP_TOWARDS:
+            # turned far enough towards side? (error from the end of the sweep has changed sign)
+            if self.odometry.heading_error(self.heading0 + self.side * self.sweep) * self.side <= 0:
+                self.set_phase(SWEEP_BACK)
+        elif self.phase == SWEEP_BACK:
+            if self.odometry.heading_error(self.heading0 - self.side * self.sweep) * self.side >= 0:
+                self.set_phase(SPIRAL)
+        else:
+            self.spiral()
+        return SEARCHING
+
+    def spiral(self):
+        """Arc towards side with a radius that grows with how far we have turned"""
+        heading = self.odometry.heading
+        self.turned += abs(wrap_angle(heading - self.prev_heading))
+        self.prev_heading = heading
+
+        radius = self.spiral_r0 + self.spiral_growth * self.turned
+        inner = self.spiral_speed * (radius - self.half_base) / (radius + self.half_base)
+        if self.side == LEFT:
+            self.pid.set_velocity(inner, self.spiral_speed)
+        else:
+            self.pid.set_velocity(self.spiral_speed, inner)
+
+    # - - - - - - - - - - - - - - - - - - - - STATS - - - - - - - - - - - - - - - - - - - - #
+    def mean_ms(self):
+        """Mean time (ms) it took to find the road, over the searches that did (and were confirmed)"""
+        return self.total_ms // self.found if self.found > 0 else 0
+
+    def report(self):
+        print("reacquire: found the road {}/{} times, mean {} ms, worst {} ms".format(
+            self.found, self.searches, self.mean_ms(), self.worst_ms))
@@ -0,0 +1,157 @@
+# Cooperative runtime: each job (sensors, control, display, state machine) runs as its own asyncio task at its
+# own rate. It is cooperative, so a job only lets the others run when it yields: a plain job runs to completion,
+# and a slow one (e.g. a ~100ms Screen.print) still holds everything up. Slow jobs must be async and yield as they
+# go, like DisplayBuffer.flush_async which sends the screen a page at a time.
+# Works with uasyncio on the Pico and with asyncio under CPython (handy for testing off the vehicle, see
+# tests/conftest.py for the ticks functions CPython is missing).
+#
+# example use of this module:
+#   from runtime import Runtime
+#   rt = Runtime()
+#   rt.every(10, control)                     # call control() every 10ms
+#   rt.every_async(200, display.flush_async)  # await display.flush_async() every 200ms
+#   rt.run()                                  # runs forever (or rt.run(5000) for 5 seconds)
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+from time import ticks_ms, ticks_diff, ticks_add
+
+
+async def sleep_ms(milliseconds):
+    """Yield to the other tasks for (at least) milliseconds"""
+    await asyncio.sleep(milliseconds / 1000)
+
+
+class DisplayBuffer:
+    def __init__(self, screen):
+        """Looks like a Screen to the state machine, but only remembers what it was asked to print. The
+        display task calls flush() (or flush_async() from a Runtime) at its own (slow) rate to actually send it
+        to the screen"""
+        self.screen = screen
+        self.message = None         # latest full-screen print (print or print_art), overwrites everything
+        self.message_is_art = False
+        self.variable = None        # latest print_variable (message, col, row), drawn over the top
+        self.pages_left = 0         # pages drawn but not sent yet, see send_page
+        self.paused = False         # update() does nothing while True (e.g. to shed the display when late)
+
+    def print(self, message):
+        self.message, self.message_is_art, self.variable = message, False, None
+
+    def print_art(self, message):
+        self.message, self.message_is_art, self.variable = message, True, None
+
+    def print_variable(self, message, col, row):
+        self.variable = (message, col, row)
+
+    def draw(self):
+        """Draw anything new into the screen's buffer, without sending it. Returns True if there was anything"""
+        drawn = False
+        if self.message is not None:
+            if self.message_is_art:
+                self.screen.draw_art(self.message)
+            else:
+                self.screen.draw(self.message)
+            self.message = None
+            drawn = True
+        if self.variable is not None:
+            self.screen.draw_variable(*self.variable)
+            self.variable = None
+            drawn = True
+        return drawn
+
+    def draw_pages(self):
+        """Draw anything new and have send_page send it, a page per call"""
+        if self.draw():
+            self.pages_left = self.screen.PAGES
+
+    def send_page(self):
+        """Send the next page of what draw_pages drew (a few ms), e.g. once per loop iteration. Returns True
+        while there are pages left"""
+        if self.pages_left == 0:
+            return False
+        self.screen.show_page(self.screen.PAGES - self.pages_left)
+        self.pages_left -= 1
+        return self.pages_left > 0
+
+    def update(self):
+        """The display path for a plain loop, call it every iteration: sends the next page of what is being
+        sent, or if that is done draws anything new to send from the next call. A few ms at most"""
+        if self.paused:
+            return
+        if not self.send_page():
+            self.draw_pages()
+
+    async def flush_async(self):
+        """Send anything new to the screen a page at a time, yielding to the other tasks in between so the
+        (slow) I2C transfer never blocks them for more than a page"""
+        if self.draw():
+            for page in range(0, self.screen.PAGES):
+                self.screen.show_page(page)
+                await sleep_ms(0)
+
+    def flush(self):
+        """Send anything new to the screen. NOTE: blocks for the whole transfer, see flush_async"""
+        if self.message is not None:
+            if self.message_is_art:
+                self.screen.print_art(self.message)
+            else:
+                self.screen.print(self.message)
+            self.message = None
+        if self.variable is not None:
+            self.screen.print_variable(*self.variable)
+            self.variable = None
+
+
+class Runtime:
+    def __init__(self):
+        """A set of periodic jobs run cooperatively"""
+        self.jobs = []  # (period_ms, function, is_async, args)
+        self.running = False
+        self.overruns = 0  # number of times a job took longer than its period
+
+    def every(self, period_ms, function, *args):
+        """Call function(*args) every period_ms once the runtime is running. It runs to completion without
+        letting the other jobs in, so keep it short"""
+        self.jobs.append((period_ms, function, False, args))
+
+    def every_async(self, period_ms, function, *args):
+        """Await the coroutine function(*args) every period_ms, for slow jobs that yield as they go"""
+        self.jobs.append((period_ms, function, True, args))
+
+    async def periodic(self, period_ms, function, is_async, args):
+        next_ms = ticks_ms()
+        while self.running:
+            if is_async:
+                await function(*args)
+            else:
+                function(*args)
+            next_ms = ticks_add(next_ms, period_ms)
+            delay = ticks_diff(next_ms, ticks_ms())
+            if delay < 0:  # we overran, so start counting again from now rather than trying to catch up
+                self.overruns += 1
+                next_ms = ticks_ms()
+                delay = 0
+            await sleep_ms(delay)
+
+    async def main(self, duration_ms=None):
+        self.running = True
+        tasks = [asyncio.create_task(self.periodic(*job)) for job in self.jobs]
+        if duration_ms is None:
+            while self.running:
+                await sleep_ms(100)
+        else:
+            await sleep_ms(duration_ms)
+            self.running = False
+        for task in tasks:
+            await task
+
+    def stop(self):
+        """Ask every job to finish after its current call"""
+        self.running = False
+
+    def run(self, duration_ms=None):
+        """Run the jobs until stop() is called, or for duration_ms if given"""
+        asyncio.run(self.main(duration_ms))
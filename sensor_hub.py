@@ -0,0 +1,113 @@
+from time import ticks_ms, ticks_diff, ticks_add
+from array import array
+
+
+# example use of this module:
+#   from sensor_hub import SensorHub, IR_L_ONROAD, RGB_HUE, RGB_PROX
+#   hub = SensorHub()
+#   hub.add(IR_L_ONROAD, vehicle.ir_l.is_on_road)                    # refreshed whenever asked for
+#   hub.add(RGB_HUE, vehicle.rgb.hue, period_ms=100)                 # at most every 100ms
+#   hub.add(RGB_PROX, vehicle.rgb.proximity_mm, always=True)         # refreshed every time, needed or not
+#   hub.refresh((IR_L_ONROAD, RGB_HUE))
+#   frame = hub.frame
+#   print(frame.values[IR_L_ONROAD], frame.values[RGB_HUE], frame.values[RGB_PROX])
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - READING SLOTS - - - - - - - - - - - - - - - - - - - - - - - - - #
+# Index of each reading in a SensorFrame. Flags (on road or not) are stored as 0/1, everything else is an int
+IR_L_ONROAD = 0          # left IR sees the road
+IR_R_ONROAD = 1          # right IR sees the road
+RGB_ONROAD = 2           # RGB ambient light says road
+RGB_DIRECTLY_ONROAD = 3  # RGB proximity says road
+AMBIENT = 4              # RGB ambient light level
+RGB_HUE = 5              # hue (0 - 359)
+RGB_PROX = 6             # RGB proximity (mm)
+US_L = 7                 # left ultrasonic distance (mm)
+US_R = 8                 # right ultrasonic distance (mm)
+IR_L_RAW = 9             # left IR analog reading (0 - 65535, filtered)
+IR_R_RAW = 10            # right IR analog reading (0 - 65535, filtered)
+NUM_READINGS = 11
+
+READING_NAMES = ("ir_l_onroad", "ir_r_onroad", "rgb_onroad", "rgb_directly_onroad", "ambient", "rgb_hue",
+                 "rgb_prox", "us_l", "us_r", "ir_l_raw", "ir_r_raw")
+
+
+class SensorFrame:
+    def __init__(self):
+        """One record of every sensor reading, allocated once and written in place each tick, so reading the
+        sensors doesn't create any new objects. values[slot] is the reading, times[slot] is the ticks_ms it
+        was taken at (readings that weren't due keep their old value and time). seq counts refreshes"""
+        self.values = array('i', (0 for _ in range(NUM_READINGS)))
+        self.times = array('i', (0 for _ in range(NUM_READINGS)))
+        self.tick_ms = 0  # when the frame was last refreshed
+        self.seq = 0
+
+    def copy_from(self, other):
+        """Copy another frame into this one (e.g. to keep a snapshot for logging), without allocating"""
+        for i in range(0, NUM_READINGS):
+            self.values[i] = other.values[i]
+            self.times[i] = other.times[i]
+        self.tick_ms = other.tick_ms
+        self.seq = other.seq
+
+    @staticmethod
+    def csv_header():
+        return "seq,tick_ms," + ",".join(READING_NAMES)
+
+    def csv_line(self):
+        """The frame as a line of csv (matching csv_header), for logging to serial or a file and replaying later"""
+        return "{},{},".format(self.seq, self.tick_ms) + ",".join([str(value) for value in self.values])
+
+    def print_csv(self):
+        print(self.csv_line())
+
+
+class SensorHub:
+    def __init__(self):
+        """Keeps the latest value of each sensor reading in a preallocated SensorFrame (hub.frame), but only
+        refreshes the readings that are asked for, and never more often than each reading allows.
+        Readings marked 'always' (safety critical ones like hazard proximity) are refreshed every time"""
+        self.frame = SensorFrame()
+        self.functions = [None] * NUM_READINGS                        # slot -> function, None if we don't have it
+        self.periods = array('i', (0 for _ in range(NUM_READINGS)))   # slot -> minimum ms between refreshes
+        self.always = array('b')                                      # slots refreshed every time
+
+    def add(self, slot, function, period_ms=0, always=False, read_now=True):
+        """Register a reading. function() is called to refresh it (it should return an int or bool), but at
+        most once every period_ms. If read_now, the reading is taken once now so there is always a value to
+        read, otherwise it is 0 until the first refresh (which it will be due for)"""
+        self.functions[slot] = function
+        self.periods[slot] = period_ms
+        if read_now:
+            self.frame.values[slot] = function()
+            self.frame.times[slot] = ticks_ms()
+        else:
+            self.frame.times[slot] = ticks_add(ticks_ms(), -period_ms)
+        if always:
+            self.always.append(slot)
+
+    def set_period(self, slot, period_ms):
+        """Change how often a reading can be refreshed (e.g. to read a slow sensor less often)"""
+        self.periods[slot] = period_ms
+
+    def refresh_reading(self, slot, now):
+        function = self.functions[slot]
+        if function is None:  # we don't have this sensor, leave it be
+            return
+        frame = self.frame
+        if ticks_diff(now, frame.times[slot]) >= self.periods[slot]:
+            frame.values[slot] = function()
+            frame.times[slot] = now
+
+    def refresh(self, slots=()):
+        """Refresh the 'always' readings plus the given slots (where they are due)"""
+        now = ticks_ms()
+        for slot in self.always:
+            self.refresh_reading(slot, now)
+        for slot in slots:
+            self.refresh_reading(slot, now)
+        self.frame.tick_ms = now
+        self.frame.seq += 1
+
+    def refresh_all(self):
+        self.refresh(range(0, NUM_READINGS))
@@ -0,0 +1,132 @@
+from time import ticks_ms, ticks_diff
+from array import array
+
+_NO_STATE = -128  # recorded as the 'from' state of the very first transition
+
+
+# example use of this module:
+#   from state_machine import StateMachine
+#   IDLE, GO = 0, 1
+#   sm = StateMachine()
+#   sm.vehicle = vehicle  # handlers get the machine, so hang anything they need off it
+#   sm.add(IDLE, "IDLE", on_enter=idle_enter, on_tick=idle_tick)
+#   sm.add(GO, "GO", on_tick=go_tick, sensors=(IR_L_ONROAD, IR_R_ONROAD))
+#   sm.start(IDLE)
+#   while True:
+#       sm.tick()
+
+
+class State:
+    def __init__(self, name, on_enter=None, on_tick=None, on_exit=None, sensors=()):
+        """A state in a StateMachine. Handlers are called with the machine as their only argument:
+        - on_enter: once, when we transition into this state
+        - on_tick: every tick while we are in this state
+        - on_exit: once, when we transition out of this state
+        sensors are the slots (see sensor_hub.py) of the sensor readings this state needs"""
+        self.name = name
+        self.on_enter = on_enter
+        self.on_tick = on_tick
+        self.on_exit = on_exit
+        self.sensors = sensors
+
+
+class StateMachine:
+    def __init__(self, history_size=16, fallback=None):
+        """A table-driven state machine: states are looked up by id when we transition, so the cost of a
+        tick doesn't grow with the number of states. The last history_size transitions are recorded.
+        Asking for a state id that was never added switches to fallback instead (or stays put if it is None)"""
+        self.states = {}        # state id -> State
+        self.state = None       # current state id
+        self.current = None     # current State
+        self.next_state = None  # state id we have been asked to transition to
+        self.fallback = fallback
+        self.t0 = ticks_ms()    # when we entered the current state
+
+        # transition history ring buffer: (time, from id, to id)
+        self.history_size = history_size
+        self.history_time = array('i', (0 for _ in range(history_size)))
+        self.history_from = array('i', (0 for _ in range(history_size)))
+        self.history_to = array('i', (0 for _ in range(history_size)))
+        self.transitions = 0    # total number of transitions
+
+    def add(self, state_id, name, on_enter=None, on_tick=None, on_exit=None, sensors=()):
+        """Register a state (see State for what the handlers do)"""
+        self.states[state_id] = State(name, on_enter, on_tick, on_exit, sensors)
+
+    def start(self, state_id):
+        """Set the initial state, entered on the first tick"""
+        self.next_state = state_id
+
+    def transition(self, state_id):
+        """Ask to move to another state. The switch (exit, then enter) happens at the start of the next tick,
+        so it is safe to call from inside a handler. The last request wins, and asking for the state we are
+        already in just cancels any earlier request"""
+        self.next_state = None if state_id == self.state else state_id
+
+    def switch(self):
+        """Exit the current state and enter the requested one, recording the transition"""
+        new_state = self.states.get(self.next_state)
+        if new_state is None:  # don't crash mid-drive over a typo'd state id
+            print("state_machine.py: state {} not found, going to {}".format(self.next_state, self.name(self.fallback)))
+            new_state = self.states.get(self.fallback)
+            if new_state is None or self.fallback == self.state:
+                self.next_state = None
+                return
+            self.next_state = self.fallback
+        if self.current is not None and self.current.on_exit is not None:
+            self.current.on_exit(self)
+
+        i = self.transitions % self.history_size
+        self.history_time[i] = ticks_ms()
+        self.history_from[i] = _NO_STATE if self.state is None else self.state
+        self.history_to[i] = self.next_state
+        self.transitions += 1
+
+        self.state, self.current, self.next_state = self.next_state, new_state, None
+        self.t0 = ticks_ms()
+        if new_state.on_enter is not None:
+            new_state.on_enter(self)
+
+    def tick(self):
+        """Run one pass of the state machine: transition if we were asked to, then run the state's on_tick"""
+        self.enter_next()
+        self.run_state()
+
+    def enter_next(self):
+        """The first half of tick: switch state (on_exit, on_enter) if a transition was asked for"""
+        if self.next_state is not None:
+            self.switch()
+
+    def run_state(self):
+        """The second half of tick: run the current state's on_tick"""
+        if self.current is not None and self.current.on_tick is not None:
+            self.current.on_tick(self)
+
+    def needed_sensors(self):
+        """The sensor readings needed for the next tick (the state we are about to enter, if we are switching).
+        NOTE: a SensorWorker calls this from the other core while tick() may be clearing next_state, so it is
+        only read once"""
+        next_state = self.next_state
+        if next_state in self.states:
+            return self.states[next_state].sensors
+        return self.current.sensors if self.current is not None else ()
+
+    def elapsed_ms(self):
+        """Time spent in the current state"""
+        return ticks_diff(ticks_ms(), self.t0)
+
+    def name(self, state_id=None):
+        """Name of a state (the current one by default)"""
+        if state_id is None:
+            state_id = self.state
+        if state_id in self.states:
+            return self.states[state_id].name
+        return "-" if state_id == _NO_STATE else str(state_id)
+
+    def print_history(self):
+        """Print the recorded transitions, oldest first"""
+        count = min(self.transitions, self.history_size)
+        for n in range(self.transitions - count, self.transitions):
+            i = n % self.history_size
+            print("{}ms: {} -> {}".format(self.history_time[i], self.name(self.history_from[i]),
+                                          self.name(self.history_to[i])))
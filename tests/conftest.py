@@ -0,0 +1,42 @@
+# The tests run under CPython off the vehicle, from the repo root: python -m pytest
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# CPython's time has no ticks functions, so give it MicroPython's: ticks wrap with a period of 2^30, and
+# ticks_diff/ticks_add wrap the same way (see MicroPython's time module docs)
+_TICKS_PERIOD = 1 << 30
+_TICKS_MAX = _TICKS_PERIOD - 1
+_TICKS_HALF = _TICKS_PERIOD // 2
+
+
+def ticks_ms():
+    return int(time.monotonic() * 1000) & _TICKS_MAX
+
+
+def ticks_us():
+    return int(time.monotonic() * 1000000) & _TICKS_MAX
+
+
+def ticks_diff(ticks1, ticks2):
+    return ((ticks1 - ticks2 + _TICKS_HALF) & _TICKS_MAX) - _TICKS_HALF
+
+
+def ticks_add(ticks, delta):
+    return (ticks + delta) & _TICKS_MAX
+
+
+def sleep_ms(milliseconds):
+    time.sleep(milliseconds / 1000)
+
+
+def sleep_us(microseconds):
+    time.sleep(microseconds / 1000000)
+
+
+for _name, _function in (("ticks_ms", ticks_ms), ("ticks_us", ticks_us), ("ticks_diff", ticks_diff),
+                         ("ticks_add", ticks_add), ("sleep_ms", sleep_ms), ("sleep_us", sleep_us)):
+    if not hasattr(time, _name):
+        setattr(time, _name, _function)
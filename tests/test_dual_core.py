@@ -0,0 +1,81 @@
+from dual_core import SensorWorker
+from sensor_hub import SensorHub, IR_L_ONROAD, RGB_PROX, US_L
+from state_machine import StateMachine
+
+
+def make_hub():
+    hub = SensorHub()
+    counts = {'ir': 0}
+
+    def ir():
+        counts['ir'] += 1
+        return counts['ir']
+
+    hub.add(IR_L_ONROAD, ir, read_now=False)
+    hub.add(RGB_PROX, lambda: 100, always=True, read_now=False)
+    hub.add(US_L, lambda: 500, read_now=False)
+    return hub
+
+
+def test_worker_publishes_before_start_returns():
+    hub = make_hub()
+    worker = SensorWorker(hub, period_ms=1)
+    worker.start()
+    try:
+        assert worker.error is None
+        assert worker.published.seq > 0
+        frame = hub.frame.__class__()
+        worker.fetch(frame)
+        assert frame.values[RGB_PROX] == 100
+        assert frame.values[US_L] == 500
+    finally:
+        worker.stop()
+    assert worker.stopped
+
+
+def test_worker_records_error_and_stops():
+    def needed():
+        raise KeyError("broken")
+
+    worker = SensorWorker(make_hub(), needed, period_ms=1)
+    worker.start()
+    worker.stop()
+    assert worker.stopped
+    assert isinstance(worker.error, KeyError)
+
+
+class SwitchingMachine(StateMachine):
+    """A StateMachine whose next_state (once racing) is cleared straight after it is read, as if tick() ran on
+    the other core in between"""
+    racing = False
+
+    @property
+    def next_state(self):
+        next_state = self._next_state
+        if self.racing:
+            self._next_state = None
+        return next_state
+
+    @next_state.setter
+    def next_state(self, state_id):
+        self._next_state = state_id
+
+
+def test_needed_sensors_while_switching():
+    """The worker asks for the needed sensors while the control loop may be switching state on the other core,
+    which clears next_state. The worker must still get a state's sensors rather than fail"""
+    sm = SwitchingMachine()
+    sm.add(0, "A", sensors=(IR_L_ONROAD,))
+    sm.add(1, "B", sensors=(US_L,))
+    sm.start(0)
+    sm.tick()
+    sm.racing = True
+
+    sm.transition(1)
+    assert sm.needed_sensors() == (US_L,)
+
+    sm.transition(1)
+    worker = SensorWorker(make_hub(), sm.needed_sensors, period_ms=1)
+    worker.start()
+    worker.stop()
+    assert worker.error is None
@@ -0,0 +1,16 @@
+from line_estimator import LineEstimator
+
+LEVELS = (1000, 0)  # (road, off-road)
+
+
+def test_lost_turns_back_the_way_we_left():
+    line = LineEstimator(LEVELS, LEVELS)
+    assert line.update(1000, 500) > 0      # road to our left
+    assert line.update(1000, 1000) == 0    # right in the middle as it went
+    assert line.update(0, 0) == 40         # lost: still turn back left
+    assert line.lost
+
+
+def test_lost_before_any_offset_goes_straight():
+    line = LineEstimator(LEVELS, LEVELS)
+    assert line.update(0, 0) == 0
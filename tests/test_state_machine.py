@@ -0,0 +1,43 @@
+from state_machine import StateMachine
+
+NULL, A = -1, 0
+
+
+def make_machine(fallback=NULL):
+    sm = StateMachine(fallback=fallback)
+    sm.entered = []
+    sm.add(NULL, "NULL", on_enter=lambda sm: sm.entered.append(NULL))
+    sm.add(A, "A", on_enter=lambda sm: sm.entered.append(A), sensors=(1, 2))
+    return sm
+
+
+def test_unknown_state_goes_to_fallback():
+    sm = make_machine()
+    sm.start(A)
+    sm.tick()
+    sm.transition(42)
+    assert sm.needed_sensors() == (1, 2)  # still ours until we switch
+    sm.tick()
+    assert sm.state == NULL
+    assert sm.entered == [A, NULL]
+
+
+def test_unknown_state_without_fallback_stays_put():
+    sm = make_machine(fallback=None)
+    sm.start(A)
+    sm.tick()
+    sm.transition(42)
+    sm.tick()
+    assert sm.state == A
+    assert sm.next_state is None
+
+
+def test_enter_next_then_run_state_is_a_tick():
+    sm = make_machine()
+    ticks = []
+    sm.states[A].on_tick = lambda sm: ticks.append(sm.state)
+    sm.start(A)
+    sm.enter_next()
+    assert sm.entered == [A] and ticks == []
+    sm.run_state()
+    assert ticks == [A]
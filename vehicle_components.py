@@ -1,14 +1,7 @@
-from machine import Pin, I2C
 from time import ticks_ms, ticks_diff, sleep_ms
-import os
-from components.rgb_sensor import RGB
-from components.us_sensor import UltraSonic
-from components.ir_sensor import InfraRed
-from components.encoder import EncoderClicker
-from components.motor import Motor
-from components.oled_screen import Screen
-from pid_control import PIDController
-from pid_control import clicks_to_mm
+
+# NOTE: everything else is imported where it is used, so importing this module (and building a lazy Vehicle)
+#       doesn't load modules for components we haven't used yet
 
 
 # - - - - - - - - - - - - - - - - - - - - DEBUG PRINTING - - - - - - - - - - - - - - - - - - - - #
@@ -22,11 +15,75 @@ def print_device_info(devices):
             print("Decimal address: ", device, " | Hexadecimal address: ", hex(device))
 
 
+# - - - - - - - - - - - - - - - - - - - - CALIBRATION HELPERS - - - - - - - - - - - - - - - - - - - - #
+class RunningStats:
+    def __init__(self):
+        """min/max/mean of a stream of readings, without keeping the readings"""
+        self.n = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.n += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def mean(self):
+        return self.total // self.n if self.n > 0 else 0
+
+
 class Vehicle:
+    MOTOR_PWM_FREQ = 1000  # Hz, recalibrate the motors (motor_speed_calibration) if you change this
+
+    # component -> (flag saying it was requested, method that builds it), see __getattr__
+    FACTORIES = {
+        'left_motor': ('init_motor', 'build_motors'),
+        'right_motor': ('init_motor', 'build_motors'),
+        'i2c_bus': ('init_i2c', 'build_i2c'),
+        'screen': ('init_screen', 'build_screen'),
+        'rgb': ('init_rgb', 'build_rgb'),
+        'us_l': ('init_us_l', 'build_us_l'),
+        'us_r': ('init_us_r', 'build_us_r'),
+        'ir_l': ('init_ir_l', 'build_ir_l'),
+        'ir_r': ('init_ir_r', 'build_ir_r'),
+        'encoder': ('init_encoder', 'build_encoder'),
+        'pid': ('init_encoder', 'build_encoder'),
+        'motor_model': ('init_encoder', 'build_encoder'),
+        'motion': ('init_encoder', 'build_motion'),
+        'odometry': ('init_encoder', 'build_odometry'),
+        'reacquire': ('init_encoder', 'build_reacquire'),
+        'line': ('init_line', 'build_line'),
+        'ir_l_sampler': ('init_ir_l', 'build_ir_l_sampler'),
+        'ir_r_sampler': ('init_ir_r', 'build_ir_r_sampler'),
+    }
+
+    # road/off-road sensors: calibration key -> (flag saying it was requested, name on screen)
+    ROAD_SENSORS = {
+        'ir_l': ('init_ir_l', 'IR-L'),
+        'ir_r': ('init_ir_r', 'IR-R'),
+        'rgb_road': ('init_rgb', 'RGB'),
+    }
+
     # - - - - - - - - - - - - - - - - - - - - INITIALISATION - - - - - - - - - - - - - - - - - - - - #
-    def __init__(self, motor=False, enc=False, screen=False, rgb=False, ir_l=False, ir_r=False, us_l=False, us_r=False):
-        """This is basically a big interface class. It initialises all devices and components that are
-        requested, calibrating them if not already calibrated."""
+    def __init__(self, motor=False, enc=False, screen=False, rgb=False, ir_l=False, ir_r=False, us_l=False, us_r=False,
+                 lazy=True, scan_i2c=True):
+        """This is basically a big interface class. It gives access to all devices and components that are
+        requested, calibrating them if not already calibrated.
+
+        If lazy, each component (and its module) is only imported, built and calibrated the first time it is
+        used (e.g. vehicle.rgb), so we can start driving without waiting for sensors we don't need yet.
+        NOTE: if a road sensor has no calibration it asks to be calibrated (interactively) when it is first used.
+        Once allow_calibration is False that raises instead, so calibrate before driving (main() does, see
+        uncalibrated_sensors) rather than have it start mid-run.
+        If scan_i2c, the I2C bus is scanned and the devices found printed out when it is set up (slow).
+        The time taken to build each component is kept, see print_boot_profile()"""
+        t0 = ticks_ms()
+        self.boot_times = []  # (component, ms) in the order they were built
+
         # Hold on to the flags containing what we wanted to initialise
         self.init_motor = motor
         self.init_encoder = enc
@@ -36,45 +93,174 @@ class Vehicle:
         self.init_ir_r = ir_r
         self.init_us_l = us_l
         self.init_us_r = us_r
+        self.init_i2c = screen or rgb
+        self.init_line = ir_l and ir_r
+        self.scan_i2c = scan_i2c
 
-        # Initialise motor
-        if self.init_motor:
-            self.left_motor = Motor("left", 8, 9, 6)
-            self.right_motor = Motor("right", 10, 11, 7)
+        # Every component's calibration, read once here (see calibration_store.py)
+        from calibration_store import CalibrationStore
+        self.calibration = CalibrationStore()
+        self.calibration.load()
+        self.calibrating = False  # True during calibrate_sensors(), so sensors built then don't start their own
+        self.allow_calibration = True  # False while driving, see calibrate_uncalibrated
+
+        # Initialise constants
+        self.SENSOR_SLEEP_MS = 10  # tells us how long to sleep before taking a new reading in update_sleep(ms)
 
-        # Initialise i2c devices
-        if self.init_screen or self.init_rgb:
-            self.i2c_bus = I2C(0, sda=Pin(12), scl=Pin(13))
+        # Initialise sensor hub, which only takes the readings we ask for, writing them into one preallocated
+        # frame (self.frame) that the state machine and logging read from
+        from sensor_hub import SensorHub
+        self.sensors = SensorHub()
+        self.frame = self.sensors.frame
+        self.add_sensor_readings()
+
+        if not lazy:
+            self.build_all()
+        self.boot_times.append(("Vehicle()", ticks_diff(ticks_ms(), t0)))
+
+    def __getattr__(self, name):
+        """Only called when name isn't an attribute yet: builds the component the first time it is used"""
+        factory = Vehicle.FACTORIES.get(name)
+        if factory is None or not getattr(self, factory[0]):
+            raise AttributeError("Vehicle has no '{}' (was it requested?)".format(name))
+        t0 = ticks_ms()
+        getattr(self, factory[1])()
+        self.boot_times.append((name, ticks_diff(ticks_ms(), t0)))
+        return self.__dict__[name]
+
+    def build_all(self):
+        """Build every requested component now rather than when it is first used"""
+        for name in Vehicle.FACTORIES:
+            if getattr(self, Vehicle.FACTORIES[name][0]):
+                getattr(self, name)
+
+    def print_boot_profile(self):
+        """Print how long each component took to build (including any components it needed, like the I2C bus)"""
+        for (name, ms) in self.boot_times:
+            print("{:>12}: {}ms".format(name, ms))
+
+    # - - - - - - - - - - - - - - - - - - - - COMPONENT FACTORIES - - - - - - - - - - - - - - - - - - - - #
+    def build_motors(self):
+        from components.motor import Motor
+        self.left_motor = Motor("left", 8, 9, 6, freq=self.MOTOR_PWM_FREQ)
+        self.right_motor = Motor("right", 10, 11, 7, freq=self.MOTOR_PWM_FREQ)
+
+    def build_i2c(self):
+        from machine import Pin, I2C
+        self.i2c_bus = I2C(0, sda=Pin(12), scl=Pin(13))
+        if self.scan_i2c:
             print_device_info(self.i2c_bus.scan())  # print debugging info
-        if self.init_screen:
-            self.screen = Screen(self.i2c_bus)
-        if self.init_rgb:
-            self.rgb = RGB(self.i2c_bus)
-            self.get_calibration_rgb_road()
 
-        # Initialise sensors
-        if self.init_us_l:
-            self.us_l = UltraSonic(trig=3, echo=2)
-        if self.init_us_r:
-            self.us_r = UltraSonic(trig=5, echo=4)
+    def build_screen(self):
+        from components.oled_screen import Screen
+        self.screen = Screen(self.i2c_bus)
+
+    def build_rgb(self):
+        from components.rgb_sensor import RGB
+        self.rgb = RGB(self.i2c_bus)
+        self.get_calibration_rgb_road()
+
+    def build_us_l(self):
+        from components.us_sensor import UltraSonic
+        self.us_l = UltraSonic(trig=3, echo=2)
+
+    def build_us_r(self):
+        from components.us_sensor import UltraSonic
+        self.us_r = UltraSonic(trig=5, echo=4)
+
+    def build_ir_l(self):
+        from machine import Pin
+        from components.ir_sensor import InfraRed
+        self.ir_l = InfraRed(Pin(27))
+        self.get_calibration_ir('ir_l', 'L', self.ir_l)
+
+    def build_ir_r(self):
+        from machine import Pin
+        from components.ir_sensor import InfraRed
+        self.ir_r = InfraRed(Pin(26))
+        self.get_calibration_ir('ir_r', 'R', self.ir_r)
+
+    def build_ir_l_sampler(self):
+        from ir_sampler import IRSampler
+        road, off_road = self.road_levels('ir_l', self.ir_l.get_sensitivity(), True)
+        self.ir_l_sampler = IRSampler(self.ir_l, band=abs(road - off_road) // 8)
+
+    def build_ir_r_sampler(self):
+        from ir_sampler import IRSampler
+        road, off_road = self.road_levels('ir_r', self.ir_r.get_sensitivity(), True)
+        self.ir_r_sampler = IRSampler(self.ir_r, band=abs(road - off_road) // 8)
+
+    def build_line(self):
+        from line_estimator import LineEstimator
+        ir_l_levels = self.road_levels('ir_l', self.ir_l.get_sensitivity(), True)
+        ir_r_levels = self.road_levels('ir_r', self.ir_r.get_sensitivity(), True)
+        rgb_levels = None
+        if self.init_rgb:
+            rgb_levels = self.road_levels('rgb_road', self.rgb.get_road_sensitivity(), False)
+        self.line = LineEstimator(ir_l_levels, ir_r_levels, rgb_levels)
+
+    def road_levels(self, key, threshold, road_is_higher):
+        """(road, off-road) readings of a road sensor, saved by calibrate_sensors(). Older calibrations only
+        have the threshold, so then we guess levels either side of it"""
+        levels = self.calibration.get_ints(key + '_levels', 2)
+        if levels is not None and levels[0] != levels[1]:
+            return levels
+        if road_is_higher:
+            return (threshold + 65535) // 2, threshold // 2
+        return threshold // 2, (threshold + 65535) // 2
+
+    def build_encoder(self):
+        from components.encoder import EncoderClicker
+        from pid_control import PIDController
+        self.encoder = EncoderClicker(19, 18)  # ENC_L corresponds to MOTOR_RIGHT so have to swap pin order!
+        self.pid = PIDController(self.encoder)
+        self.get_calibration_motor()
+        self.get_calibration_pid()
+
+    def build_motion(self):
+        from motion_queue import MotionQueue
+        self.motion = MotionQueue(self.pid, odometry=self.odometry)
+
+    def build_odometry(self):
+        from odometry import Odometry
+        self.odometry = Odometry(self.encoder)
+
+    def build_reacquire(self):
+        from reacquire import Reacquirer
+        self.reacquire = Reacquirer(self.pid, self.odometry)
+
+    def add_sensor_readings(self):
+        """Registers the readings of every sensor we requested with the sensor hub, along with how often
+        they can be refreshed. The hazard proximity is always kept current. Nothing is read (or built) until
+        the hub is first refreshed"""
+        from sensor_hub import IR_L_ONROAD, IR_R_ONROAD, RGB_ONROAD, RGB_DIRECTLY_ONROAD, AMBIENT, RGB_HUE, \
+            RGB_PROX, US_L, US_R, IR_L_RAW, IR_R_RAW
+        # the IR sensors are oversampled and filtered (see IRSampler), so their on-road flags don't flicker
         if self.init_ir_l:
-            self.ir_l = InfraRed(Pin(27))
-            self.get_calibration_ir('ir_l.txt', 'L', self.ir_l)
+            self.sensors.add(IR_L_ONROAD, lambda: self.ir_l_sampler.is_on_road(), read_now=False)
+            self.sensors.add(IR_L_RAW, lambda: self.ir_l_sampler.reading(), read_now=False)
         if self.init_ir_r:
-            self.ir_r = InfraRed(Pin(26))
-            self.get_calibration_ir('ir_r.txt', 'R', self.ir_r)
-        if self.init_encoder:
-            self.encoder = EncoderClicker(19, 18)  # ENC_L corresponds to MOTOR_RIGHT so have to swap pin order!
-            self.pid = PIDController(self.encoder)
-
-        # Initialise constants
-        self.SENSOR_SLEEP_MS = 10  # tells us how long to sleep before taking a new reading in update_sleep(ms)
+            self.sensors.add(IR_R_ONROAD, lambda: self.ir_r_sampler.is_on_road(), read_now=False)
+            self.sensors.add(IR_R_RAW, lambda: self.ir_r_sampler.reading(), read_now=False)
+        if self.init_rgb:
+            self.sensors.add(RGB_PROX, lambda: self.rgb.proximity_mm(), always=True, read_now=False)
+            self.sensors.add(RGB_ONROAD, lambda: self.rgb.is_on_road(), period_ms=20, read_now=False)
+            self.sensors.add(RGB_DIRECTLY_ONROAD, lambda: self.rgb.is_on_road_by_prox(), period_ms=20, read_now=False)
+            self.sensors.add(AMBIENT, lambda: self.rgb.ambient(), period_ms=50, read_now=False)
+            self.sensors.add(RGB_HUE, lambda: self.rgb.hue(), period_ms=100, read_now=False)
+        # NOTE: the ultrasonic averages go stale after MAX_TIMEDIFF_MS, so if nothing asks for them for a while
+        #       the next reading resets the sensor (slow). Ask for them regularly in states that rely on them
+        if self.init_us_l:
+            self.sensors.add(US_L, lambda: self.us_l.proximity_mm(), period_ms=50, read_now=False)
+        if self.init_us_r:
+            self.sensors.add(US_R, lambda: self.us_r.proximity_mm(), period_ms=50, read_now=False)
 
     # - - - - - - - - - - - - - - - - - - - - GENERAL FUNCTIONS - - - - - - - - - - - - - - - - - - - - #
     def set_motor(self, lduty, rduty):
-        """Set motor duties. This function safely clamps the duties to values between -100 to 100
-            :type: lduty: int
-            :type: rduty: int"""
+        """Set motor duties. This function safely clamps the duties to values between -100 to 100.
+        Duties can be floats, they are applied with a resolution of 0.1
+            :type: lduty: float
+            :type: rduty: float"""
         # Sanitise input (0 <= left duty && right duty <= 100)
         lduty = min(lduty, 100)
         rduty = min(rduty, 100)
@@ -96,6 +282,11 @@ class Vehicle:
             self.right_motor.set_backwards()
             self.right_motor.duty(rduty * -1)
 
+    def brake(self):
+        """Actively brake both motors, stops in a shorter distance than set_motor(0, 0) which just coasts"""
+        self.left_motor.brake()
+        self.right_motor.brake()
+
     def update_sleep(self, milliseconds):
         """Sleeps for a time (ms) while maintaining sensor readings. Important
         for the ultrasonic sensors which average over multiple readings (i.e. we can't
@@ -109,190 +300,330 @@ class Vehicle:
             sleep_ms(self.SENSOR_SLEEP_MS)
 
     # - - - - - - - - - - - - - - - - - - - - CALIBRATION ROUTINES - - - - - - - - - - - - - - - - - - - - #
-    def motor_calibration(self):
-        """Routine for testing the difference in speed between the left and right motors at different duties"""
-        f = open('motor.txt', 'w')
-        f.write('speed,offset\n')
-        for speed in range(40, 90, 2):
-            # get up to speed
-            self.screen.print("~MotorCalibrate~\n\nSpeed {}".format(speed))
-            self.set_motor(0, 0)
-            sleep_ms(3000)
-            self.set_motor(speed, speed)
-            sleep_ms(500)
-
-            # our reference motor is the left motor -> increase/decrease right motor until it matches
-            tolerance = 3
-            offset = 0
-            while True:
-                # travel up to 500mm so we get an error value
-                self.screen.print("~MotorCalibrate~\n\nSpeed {}\nOffset {}\nclk_l {}\nclk_r {}".format(
-                    speed, offset, self.encoder.get_left(), self.encoder.get_right()))
-
+    def motor_calibration(self, speeds=range(40, 90, 2), distance_mm=300, tolerance=0.02, max_runs=8,
+                          screen_ms=500):
+        """Routine for finding the offset (duty taken from the left and given to the right motor) that makes
+        both wheels turn at the same speed, at different duties. For each duty:
+        - start from the offset we found at the last duty (neighbouring duties need similar offsets)
+        - drive distance_mm and estimate the offset straight from the ratio of the wheel speeds (each wheel's
+          speed is roughly proportional to its duty above the deadband)
+        - once we have offsets either side of the answer, keep the estimate inside that bracket (bisecting if
+          it lands outside), until the wheels are within tolerance (fraction of clicks) or the bracket closes
+        If we run out of max_runs, the offset that measured closest is used. If a wheel doesn't move at all we
+        stop with an error (returns None) rather than save a meaningless table.
+        The screen is only updated every screen_ms so it doesn't upset the timing. The speed -> offset table
+        is saved to the calibration store for the MotorModel"""
+        from pid_control import clicks_to_mm
+        model = self.motor_model
+        self.encoder.set_left_dir(True)
+        self.encoder.set_right_dir(True)
+        table = []
+        offset = 0
+        t_screen = ticks_ms()
+        for speed in speeds:
+            low, high = None, None  # offsets known to be too small (left faster) / too big (right faster)
+            best, best_error = offset, None  # the offset that measured closest, in case we run out of runs
+            for run in range(0, max_runs):
+                # get up to speed, then measure how far each wheel goes
+                self.set_motor(speed - offset, speed + offset)
+                sleep_ms(200)
                 self.encoder.clear_count()
-                self.set_motor(speed-offset, speed+offset)
-                while clicks_to_mm(self.encoder.get_left()) < 500:
-                    self.screen.print("~MotorCalibrate~\n\nSpeed {}\nOffset {}\nclk_l {}\nclk_r {}".format(
-                        speed, offset, self.encoder.get_left(), self.encoder.get_right()))
+                t0 = ticks_ms()
+                while clicks_to_mm(self.encoder.get_left()) < distance_mm and ticks_diff(ticks_ms(), t0) < 3000:
+                    if ticks_diff(ticks_ms(), t_screen) >= screen_ms:
+                        self.screen.print("~MotorCalibrate~\n\nSpeed {}\nOffset {}\nRun {}".format(
+                            speed, offset, run + 1))
+                        t_screen = ticks_ms()
+                clicks_l, clicks_r = self.encoder.get_left(), self.encoder.get_right()
+                if clicks_l == 0 or clicks_r == 0:
+                    self.set_motor(0, 0)
+                    self.screen.print("~MotorCalibrate~\nError: a wheel didn't move at speed {}".format(speed))
+                    return None
 
                 # check what the error we got was
-                error = self.encoder.get_left() - self.encoder.get_right()
-                if abs(error) < tolerance:   # if error is small enough, we found our target offset!
+                error = clicks_l - clicks_r
+                fraction = abs(error) / max(clicks_l, clicks_r)
+                if best_error is None or fraction < best_error:
+                    best, best_error = offset, fraction
+                if fraction <= tolerance:  # small enough, we found our offset!
+                    break
+                if error > 0:  # left is faster -> we need a bigger offset
+                    low = offset
+                else:          # right is faster -> we need a smaller offset
+                    high = offset
+
+                # estimate the offset from the speed ratio: clicks ~ k * (duty - deadband) on each wheel
+                duty_l = max(speed - offset - model.deadband_left, 1)
+                duty_r = max(speed + offset - model.deadband_right, 1)
+                guess = offset + round(error / (clicks_l / duty_l + clicks_r / duty_r + 1e-6))
+                if guess == offset:
+                    guess += 1 if error > 0 else -1
+                if (low is not None and guess <= low) or (high is not None and guess >= high):
+                    if low is None or high is None:  # outside the only bound we have: just step past it
+                        guess = low + 1 if high is None else high - 1
+                    else:
+                        guess = (low + high) // 2
+                if low is not None and high is not None and high - low <= 1:  # bracket closed
+                    offset = low if error > 0 else high
                     break
-                elif error > 0:              # for a positive error -> increase right motor
-                    offset += 1
-                else:                        # for a negative error -> decrease right motor
-                    offset -= 1
-            f.write('{},{}\n'.format(speed, offset))
-        f.close()
+                offset = guess
+            else:  # out of runs, and the last guess was never driven
+                offset = best
+            table.append((speed, offset))
+        self.set_motor(0, 0)
+        self.screen.print("~MotorCalibrate~\n\nDone!")
+        self.calibration.set('motor_offsets', table)
+        self.calibration.save()
+        model.set_offsets([row[0] for row in table], [row[1] for row in table])
+
+    def motor_speed_calibration(self):
+        """Routine for measuring how fast each wheel travels (mm/s) at different duties. Saved to the
+        calibration store for the MotorModel to use as feed-forward"""
+        from pid_control import MM_PER_CLICK
+        table = []
+        self.encoder.set_left_dir(True)
+        self.encoder.set_right_dir(True)
+        for duty in range(20, 80, 4):
+            self.screen.print("~MotorCalibrate~\n\nDuty {}".format(duty))
+            # get up to speed
+            self.set_motor(duty, duty)
+            sleep_ms(300)
+
+            # measure how far each wheel travels in a fixed time
+            self.encoder.clear_count()
+            t0 = ticks_ms()
+            sleep_ms(500)
+            dt = ticks_diff(ticks_ms(), t0)
+            left = int(self.encoder.get_left() * MM_PER_CLICK * 1000 / dt)
+            right = int(self.encoder.get_right() * MM_PER_CLICK * 1000 / dt)
+            table.append((duty, left, right))
+        self.set_motor(0, 0)
+        self.calibration.set('motor_speeds', table)
+        self.calibration.save()
+        self.motor_model.set_speeds(*self.calibration.get_table('motor_speeds', 3))
+
+    def get_calibration_motor(self):
+        """Routine for loading the motor calibration tables (if we have them) into the PID's motor model.
+        Unlike the sensors we don't calibrate at boot since it needs room to drive; run
+        motor_calibration() and motor_speed_calibration() instead"""
+        from motor_model import MotorModel
+        self.motor_model = MotorModel()
+        offsets = self.calibration.get_table('motor_offsets', 2)
+        if offsets is not None:
+            self.motor_model.set_offsets(*offsets)
+        speeds = self.calibration.get_table('motor_speeds', 3)
+        if speeds is not None:
+            self.motor_model.set_speeds(*speeds)
+        self.pid.set_motor_model(self.motor_model)
+
+    def get_calibration_pid(self):
+        """Routine for reading the PID constants found by autotune_pid(). Like the motor we don't tune at
+        boot, if there is nothing saved we just keep PIDController's defaults"""
+        gains = self.calibration.get_floats('pid', 3)
+        if gains is not None and gains[0] > 0 and gains[1] >= 0 and gains[2] >= 0:
+            self.pid.set_gains(*gains)
+
+    def autotune_pid(self, duty=60, duration_ms=800, sample_ms=10):
+        """Routine for tuning the PID constants from a step response. Both wheels are given a step in duty and
+        the encoder clicks are sampled. Each wheel looks like an integrator with a lag and a delay, so once it
+        is up to speed the clicks lie on a straight line: the slope gives the plant gain and where the line
+        crosses zero gives the delay + lag. Gains come from the SIMC tuning rules and are saved to the calibration
+        store"""
+        from array import array
+        num_samples = duration_ms // sample_ms
+        clicks_left = array('i', (0 for _ in range(num_samples)))
+        clicks_right = array('i', (0 for _ in range(num_samples)))
+
+        # step experiment
+        self.screen.print("~PID Autotune~\n\nStep duty {}".format(duty))
+        self.set_motor(0, 0)
+        sleep_ms(1000)  # make sure we start stationary
+        self.encoder.clear_count()
+        self.encoder.set_left_dir(True)
+        self.encoder.set_right_dir(True)
+        self.set_motor(duty, duty)
+        t0 = ticks_ms()
+        for i in range(0, num_samples):
+            while ticks_diff(ticks_ms(), t0) < i * sample_ms:
+                pass
+            clicks_left[i] = self.encoder.get_left()
+            clicks_right[i] = self.encoder.get_right()
+        self.set_motor(0, 0)
+
+        # identify each wheel, then tune for the slower/laggier of the two so both stay stable
+        model = self.pid.motor_model
+        gain_l, delay_l, lag_l = self.identify_step(clicks_left, sample_ms, duty - model.deadband_left)
+        gain_r, delay_r, lag_r = self.identify_step(clicks_right, sample_ms, duty - model.deadband_right)
+        if gain_l <= 0 or gain_r <= 0:
+            self.screen.print("~PID Autotune~\nError: a wheel didn't move. Is the duty too low?")
+            return None
+        gain = min(gain_l, gain_r)
+        delay = max(delay_l, delay_r, sample_ms)
+        lag = max(lag_l, lag_r)
+
+        # SIMC rules for an integrating process with lag (tau_c = delay), converted from series to parallel form
+        kc = 1 / (gain * 2 * delay)
+        ti = 8 * delay
+        td = lag
+        kp = kc * (1 + td / ti)
+        ki = kp / (ti + td)
+        kd = kp * ti * td / (ti + td)
+        print("autotune: gain {} clk/ms/duty, delay {}ms, lag {}ms -> kp {} ki {} kd {}".format(
+            gain, delay, lag, kp, ki, kd))
+
+        self.pid.set_gains(kp, ki, kd)
+        self.calibration.set('pid', (kp, ki, kd))
+        self.calibration.save()
+        self.screen.print("~PID Autotune~\n\nkp {:.3f}\nki {:.5f}\nkd {:.1f}".format(kp, ki, kd))
+        return kp, ki, kd
+
+    @staticmethod
+    def identify_step(clicks, sample_ms, duty):
+        """Returns (gain (clicks/ms per duty), delay (ms), lag (ms)) from the clicks sampled in a step response"""
+        # delay: time until the wheel first moves
+        delay = 0
+        while delay < len(clicks) and clicks[delay] == 0:
+            delay += 1
+        delay *= sample_ms
+
+        # fit a straight line to the last half of the response (when we should be up to speed)
+        n = len(clicks)
+        start = n // 2
+        count = n - start
+        mean_t = sample_ms * (start + n - 1) / 2
+        mean_x = sum(clicks[start:]) / count
+        cov, var = 0, 0
+        for i in range(start, n):
+            dt = i * sample_ms - mean_t
+            cov += dt * (clicks[i] - mean_x)
+            var += dt * dt
+        slope = cov / var
+        if slope <= 0 or duty <= 0:
+            return 0, delay, 0
+
+        # the line crosses zero at delay + lag
+        lag = max(mean_t - mean_x / slope - delay, 0)
+        return slope / duty, delay, lag
 
     def get_calibration_rgb_road(self):
-        """Routine for reading the current calibration for the rgb sensor"""
-        try:
-            f = open('rgb_road.txt', 'r')
-            self.rgb.set_road_sensitivity(int(f.read()))
-            f.close()
-        except OSError:
-            f = open('rgb_road.txt', 'w')
-            self.calibrate_rgb_road()
-            f.write(str(self.rgb.get_road_sensitivity()))
-            f.close()
-        except ValueError:
-            os.remove('rgb_road.txt',)
-            f = open('rgb_road.txt', 'w')
-            self.calibrate_rgb_road()
-            f.write(str(self.rgb.get_road_sensitivity()))
-            f.close()
+        """Routine for reading the current calibration for the rgb sensor. If we don't have one, every
+        requested road sensor that needs calibrating is calibrated together (see calibrate_sensors)"""
+        sensitivity = self.calibration.get_int('rgb_road', 0, 65535)
+        if sensitivity is not None:
+            self.rgb.set_road_sensitivity(sensitivity)
+        elif not self.calibrating:
+            self.calibrate_uncalibrated()
 
     def calibrate_rgb_road(self):
         """Calibrates the RGB Sensor to distinguish between road and off-road surfaces"""
-        self.screen.print("~CalibrateRGB~\nPosition RGB on\nthe ROAD surface")
-        for i in range(5, 0, -1):  # countdown
-            self.screen.fill_rect(0, 7, 16, 1, 0)  # clear old msg
-            self.screen.print_unformatted("Measuring in " + str(i), 1, 7)
-            sleep_ms(1000)
-
-        self.screen.fill_rect(0, 7, 16, 1, 0)  # clear old msg
-        road_readings = []
-        animation_stage = 0
-        for i in range(0, 12, 1):
-            # get reading
-            road_readings.append(self.rgb.ambient())
-            # every 3 loops update animation
-            if i % 3 == 0:
-                self.screen.fill_rect(5, 6, 6, 1, 0)  # clear old animation
-                self.screen.print_unformatted(". " * animation_stage, 5, 6)
-                animation_stage = (animation_stage + 1) % 4  # loop animation
-            # delay
-            sleep_ms(150)
-
-        self.screen.print("~CalibrateRGB~\nPosition RGB on\nthe OFF-ROAD surface")
-        for i in range(5, 0, -1):  # countdown
-            self.screen.fill_rect(0, 7, 16, 1, 0)  # clear old msg
-            self.screen.print_unformatted("Measuring in " + str(i), 1, 7)
-            sleep_ms(1000)
-
-        self.screen.fill_rect(0, 7, 16, 1, 0)  # clear old msg
-        animation_stage = 0
-        off_road_readings = []
-        for i in range(0, 12, 1):
-            # get reading
-            off_road_readings.append(self.rgb.ambient())
-            # every 3 loops update animation
-            if i % 3 == 0:
-                self.screen.fill_rect(5, 6, 6, 1, 0)  # clear old animation
-                self.screen.print_unformatted(". " * animation_stage, 5, 6)
-                animation_stage = (animation_stage + 1) % 4  # loop animation
-            # delay
-            sleep_ms(150)
-
-        # calculate sensitivity threshold as in between road and off-road readings
-        road = min(road_readings)
-        print(road)
-        off_road = max(off_road_readings)
-        print(off_road)
-        if road < off_road:  # our readings are good
-            sensitivity = int((road + off_road) / 2)
-            print(sensitivity)
-            self.rgb.set_road_sensitivity(sensitivity)
-        else:  # let's try again since we didn't get a clear distinction
-            self.screen.print("~CalibrateRGB~\nError: unclear distinction between road and off-road. Retry!")
-            sleep_ms(2000)
-            self.calibrate_rgb_road()
+        self.calibrate_sensors(('rgb_road',))
 
-    def get_calibration_ir(self, ir_str, ir_letter, ir):
-        """Routine for reading the current calibration for the ir sensors"""
-        try:
-            f = open(ir_str, 'r')
-            ir.set_sensitivity(int(f.read()))
-            f.close()
-        except OSError:
-            f = open(ir_str, 'w')
-            self.calibrate_ir(ir, ir_letter)
-            f.write(str(ir.get_sensitivity()))
-            f.close()
-        except ValueError:
-            os.remove(ir_str)
-            f = open(ir_str, 'w')
-            self.calibrate_ir(ir, ir_letter)
-            f.write(str(ir.get_sensitivity()))
-            f.close()
+    def get_calibration_ir(self, key, ir_letter, ir):
+        """Routine for reading the current calibration for the ir sensors. If we don't have one, every
+        requested road sensor that needs calibrating is calibrated together (see calibrate_sensors)"""
+        sensitivity = self.calibration.get_int(key, 0, 65535)
+        if sensitivity is not None:
+            ir.set_sensitivity(sensitivity)
+        elif not self.calibrating:
+            self.calibrate_uncalibrated()
 
     def calibrate_ir(self, ir, ir_letter):
         """Calibrates the IR Sensor to distinguish between road and off-road surfaces"""
-        self.screen.print("~Calibrate IR~\nHold IR" + ir_letter + " above\nthe ROAD surface")
-        for i in range(5, 0, -1):  # countdown
-            self.screen.fill_rect(0, 7, 16, 1, 0)  # clear old msg
-            self.screen.print_unformatted("Measuring in " + str(i), 1, 7)
-            sleep_ms(1000)
-
-        self.screen.fill_rect(0, 7, 16, 1, 0)  # clear old msg
-        road_readings = []
-        animation_stage = 0
-        for i in range(0, 12, 1):
-            # get reading
-            road_readings.append(ir.reading())
-            # every 3 loops update animation
-            if i % 3 == 0:
-                self.screen.fill_rect(5, 6, 6, 1, 0)  # clear old animation
-                self.screen.print_unformatted(". " * animation_stage, 5, 6)
-                animation_stage = (animation_stage + 1) % 4  # loop animation
-            # delay
-            sleep_ms(150)
-
-        self.screen.print("~Calibrate IR~\nHold IR" + ir_letter + " above\nthe OFF-ROAD surface")
+        self.calibrate_sensors(('ir_' + ir_letter.lower(),))
+
+    def calibrate_uncalibrated(self):
+        """Calibrate every requested road sensor without a calibration. Refuses (raises) while driving, when a
+        sensor built for the first time mid-run would otherwise stop to ask for its road and off-road surfaces"""
+        if not self.allow_calibration:
+            raise RuntimeError("vehicle_components.py: {} not calibrated, and we can't calibrate while driving. "
+                               "Run calibrate_sensors() first".format(" ".join(self.uncalibrated_sensors())))
+        self.calibrate_sensors(self.uncalibrated_sensors())
+
+    def uncalibrated_sensors(self):
+        """Calibration keys of the requested road sensors we don't have a (valid) calibration for"""
+        keys = []
+        for key in Vehicle.ROAD_SENSORS:
+            if getattr(self, Vehicle.ROAD_SENSORS[key][0]) and self.calibration.get_int(key, 0, 65535) is None:
+                keys.append(key)
+        return keys
+
+    def road_sensor(self, key):
+        """(function taking a reading, True if the road reads higher than off-road, function setting the threshold)
+        of a road sensor"""
+        if key == 'rgb_road':  # ambient light: the road is darker
+            return self.rgb.ambient, False, self.rgb.set_road_sensitivity
+        ir = self.ir_l if key == 'ir_l' else self.ir_r  # IR: the road reflects more
+        return ir.reading, True, ir.set_sensitivity
+
+    def calibrate_sensors(self, keys=None, samples=12, sample_ms=150):
+        """Calibrates road sensors (calibration keys, see ROAD_SENSORS, all requested ones by default) to
+        distinguish between road and off-road surfaces, in one pass: they are all sampled together over the
+        road, then over the off-road surface. Each threshold is halfway across the gap between the two, and
+        only the sensors that didn't see a clear gap are asked for again. The mean road and off-road levels are
+        saved too (as <key>_levels) for the LineEstimator"""
+        if keys is None:
+            keys = [key for key in Vehicle.ROAD_SENSORS if getattr(self, Vehicle.ROAD_SENSORS[key][0])]
+        keys = list(keys)
+        self.calibrating = True
+        try:
+            while len(keys) > 0:
+                sensors = [self.road_sensor(key) for key in keys]
+                names = " ".join([Vehicle.ROAD_SENSORS[key][1] for key in keys])
+                road = self.sample_road_sensors("~Calibrate~\nHold " + names + "\nabove the ROAD\nsurface",
+                                                sensors, samples, sample_ms)
+                off_road = self.sample_road_sensors("~Calibrate~\nHold " + names + "\nabove the OFF-ROAD\nsurface",
+                                                    sensors, samples, sample_ms)
+
+                failed = []
+                for i in range(0, len(keys)):
+                    (read, road_is_higher, set_threshold) = sensors[i]
+                    # the gap between the closest road and off-road readings
+                    if road_is_higher:
+                        low, high = off_road[i].max, road[i].min
+                    else:
+                        low, high = road[i].max, off_road[i].min
+                    print("{}: road {}-{}, off-road {}-{}".format(keys[i], road[i].min, road[i].max,
+                                                                  off_road[i].min, off_road[i].max))
+                    if low < high:  # our readings are good
+                        set_threshold((low + high) // 2)
+                        self.calibration.set(keys[i], (low + high) // 2)
+                        self.calibration.set(keys[i] + '_levels', (road[i].mean(), off_road[i].mean()))
+                    else:  # no clear distinction, so we'll try this one again
+                        failed.append(keys[i])
+                self.calibration.save()
+
+                if len(failed) > 0:
+                    self.screen.print("~Calibrate~\nError: unclear distinction between road and off-road for "
+                                      + " ".join([Vehicle.ROAD_SENSORS[key][1] for key in failed]) + ". Retry!")
+                    sleep_ms(2000)
+                keys = failed
+        finally:
+            self.calibrating = False
+
+    def sample_road_sensors(self, message, sensors, samples, sample_ms):
+        """Shows the message, counts down, then samples every sensor (see road_sensor) together samples times.
+        Returns RunningStats per sensor"""
+        self.screen.print(message)
         for i in range(5, 0, -1):  # countdown
             self.screen.fill_rect(0, 7, 16, 1, 0)  # clear old msg
             self.screen.print_unformatted("Measuring in " + str(i), 1, 7)
             sleep_ms(1000)
 
         self.screen.fill_rect(0, 7, 16, 1, 0)  # clear old msg
+        stats = [RunningStats() for _ in sensors]
         animation_stage = 0
-        off_road_readings = []
-        for i in range(0, 12, 1):
-            # get reading
-            off_road_readings.append(ir.reading())
+        for i in range(0, samples, 1):
+            # get readings
+            for j in range(0, len(sensors)):
+                stats[j].add(sensors[j][0]())
             # every 3 loops update animation
             if i % 3 == 0:
                 self.screen.fill_rect(5, 6, 6, 1, 0)  # clear old animation
                 self.screen.print_unformatted(". " * animation_stage, 5, 6)
                 animation_stage = (animation_stage + 1) % 4  # loop animation
             # delay
-            sleep_ms(150)
-
-        # calculate sensitivity threshold as in between road and off-road readings
-        road = min(road_readings)
-        print(road)
-        off_road = max(off_road_readings)
-        print(off_road)
-        if road > off_road:  # our readings are good
-            sensitivity = int((road + off_road) / 2)
-            print(sensitivity)
-            ir.set_sensitivity(sensitivity)
-        else:  # let's try again since we didn't get a clear distinction
-            self.screen.print("~Calibrate IR~\nError: unclear distinction between road and off-road. Retry!")
-            sleep_ms(2000)
-            self.calibrate_ir(ir, ir_letter)
+            sleep_ms(sample_ms)
+        return stats
 
     def calibrate_rgb(self, reference_us):
         """Calibrates RGB Sensor based on Ultrasonic Sensor data"""